@@ -0,0 +1,420 @@
+"""Benchmark offline do MoneyupInvestiments.
+
+Executa os comandos reais (`!analisar`, `!grafico_acao`, `!comparar`) com
+usuários simultâneos contra substitutos locais: canal/contexto do Discord
+falsos, um modelo generativo falso com latência e streaming configuráveis, um
+servidor aiohttp no lugar do SGS do Banco Central e respostas prontas da Alpha
+Vantage. Nenhuma chave ou conexão externa é necessária.
+
+Uso:
+    python benchmark.py --users 50
+    python benchmark.py --scenarios grafico_acao --users 200 --json resultado.json
+    python benchmark.py --baseline resultado.json --tolerance 0.25
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+import zlib
+
+# A configuração do bot é lida na importação: os arquivos locais vão para um
+# diretório temporário e as cotas não limitam o teste.
+BENCHMARK_DIR = tempfile.mkdtemp(prefix='moneyup-bench-')
+os.environ['DATA_DIR'] = BENCHMARK_DIR
+os.environ.setdefault('GEMINI_API_KEY', 'benchmark')
+os.environ.setdefault('ALPHA_VANTAGE_API_KEY', 'benchmark')
+os.environ.setdefault('ALPHA_VANTAGE_PER_MINUTE', '100000')
+os.environ.setdefault('ALPHA_VANTAGE_PER_DAY', '1000000')
+os.environ.setdefault('ANALYSIS_CACHE_PATH', '')
+
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+import main
+
+SCENARIOS = ['analisar', 'analisar_cache', 'grafico_acao', 'comparar']
+SYMBOLS = ['IBM', 'MSFT', 'GOOGL', 'AAPL', 'AMZN', 'PETR4.SA', 'VALE3.SA', 'ITUB4.SA']
+CHART_OPTIONS = [(), ('mm20',), ('mm20', 'bollinger'), ('rsi',), ('mme50', 'vol', 'dd')]
+
+CANNED_ANALYSIS = """### 1. Panorama Econômico Atual e Perspectivas para o Mês
+A Selic segue elevada e a inflação mostra sinais de desaceleração, o que favorece a renda fixa pós-fixada.
+
+---
+
+### 2. Análise de Investimentos Recomendados para o Mês
+
+#### Renda Fixa (Tesouro Direto, CDBs, LCIs/LCAs)
+- **Vantagens**: Previsibilidade e boa remuneração com a Selic alta.
+- **Desvantagens**: Menor potencial de ganho no longo prazo.
+- **Por que agora?**: Juros reais positivos.
+
+---
+
+### 3. Sugestão de Carteira Diversificada para o Mês
+- **Renda Fixa (Tesouro Selic / CDB)**: [50]%
+  * **Sugestão de Ativo**: Tesouro Selic 2029
+  * **Valor Alocado**: R$ 500,00
+  * **Justificativa**: Liquidez diária e baixo risco.
+- **Fundos Imobiliários (FIIs)**: [20]%
+  * **Sugestão de Ativo**: HGLG11
+  * **Valor Alocado**: R$ 200,00
+  * **Justificativa**: Renda mensal isenta.
+- **Ações**: [25]%
+  * **Sugestão de Ativo**: BOVA11
+  * **Valor Alocado**: R$ 250,00
+  * **Justificativa**: Exposição diversificada à bolsa.
+- **Criptomoedas**: [5]%
+  * **Sugestão de Ativo**: ETF BITH11 (Bitcoin)
+  * **Valor Alocado**: R$ 50,00
+  * **Justificativa**: Pequena exposição a um ativo de alto risco.
+
+---
+
+**Observação Importante:** Este é um exemplo educativo gerado para o benchmark.
+"""
+
+# --- Substitutos do Discord ---
+
+class FakeMessage:
+    def __init__(self, channel, content, author=None):
+        self.channel = channel
+        self.content = content
+        self.author = author
+
+    async def edit(self, content=None, **kwargs):
+        await self.channel.api_call('edit')
+        self.content = content
+
+class FakeAuthor:
+    def __init__(self, user_id):
+        self.id = user_id
+        self.bot = False
+        self.mention = f"<@{user_id}>"
+
+class FakeChannel:
+    # Cada chamada à API custa `latency` segundos; `on_send` simula o usuário
+    # reagindo ao que o bot escreve.
+    def __init__(self, channel_id, latency, on_send=None):
+        self.id = channel_id
+        self.latency = latency
+        self.on_send = on_send
+        self.calls = {'send': 0, 'edit': 0, 'file': 0}
+
+    async def api_call(self, kind):
+        self.calls[kind] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+    async def send(self, content=None, embed=None, file=None, embeds=None, files=None, **kwargs):
+        await self.api_call('file' if file is not None or files else 'send')
+        message = FakeMessage(self, content)
+        if self.on_send is not None and content:
+            self.on_send(content)
+        return message
+
+class FakeContext:
+    def __init__(self, channel, author):
+        self.channel = channel
+        self.author = author
+        self.guild = None
+        self.message = FakeMessage(channel, "", author)
+
+    async def send(self, content=None, **kwargs):
+        return await self.channel.send(content, **kwargs)
+
+# --- Substitutos das dependências externas ---
+
+class FakeChunk:
+    def __init__(self, text):
+        self.text = text
+
+class FakeStream:
+    def __init__(self, chunks, first_chunk_latency, chunk_delay):
+        self.chunks = chunks
+        self.first_chunk_latency = first_chunk_latency
+        self.chunk_delay = chunk_delay
+
+    async def __aiter__(self):
+        await asyncio.sleep(self.first_chunk_latency)
+        for chunk in self.chunks:
+            yield FakeChunk(chunk)
+            await asyncio.sleep(self.chunk_delay)
+
+class FakeGenerativeModel:
+    # Devolve CANNED_ANALYSIS em pedaços de `chunk_size` caracteres
+    def __init__(self, latency, chunk_delay, chunk_size=120):
+        self.latency = latency
+        self.chunk_delay = chunk_delay
+        self.chunk_size = chunk_size
+        self.requests = 0
+
+    async def generate_content_async(self, prompt, stream=False):
+        self.requests += 1
+        chunks = [CANNED_ANALYSIS[i:i + self.chunk_size] for i in range(0, len(CANNED_ANALYSIS), self.chunk_size)]
+        if stream:
+            return FakeStream(chunks, self.latency, self.chunk_delay)
+        await asyncio.sleep(self.latency + self.chunk_delay * len(chunks))
+        return FakeChunk(CANNED_ANALYSIS)
+
+class FakeTimeSeries:
+    # Mesma interface de alpha_vantage.timeseries.TimeSeries (formato pandas);
+    # roda em uma thread, como a chamada bloqueante real.
+    def __init__(self, latency, days=2500):
+        self.latency = latency
+        self.days = days
+        self.requests = 0
+
+    def get_daily(self, symbol, outputsize='compact'):
+        self.requests += 1
+        time.sleep(self.latency)
+        days = self.days if outputsize == 'full' else 100
+        index = main.pd.bdate_range(end=main.pd.Timestamp.now().normalize(), periods=days)
+        rng = main.np.random.default_rng(zlib.crc32(symbol.encode()))
+        close = 100 * main.np.exp(main.np.cumsum(rng.normal(0.0003, 0.015, days)))
+        frame = main.pd.DataFrame({
+            '1. open': close * 0.998,
+            '2. high': close * 1.01,
+            '3. low': close * 0.99,
+            '4. close': close,
+            '5. volume': rng.integers(1_000_000, 5_000_000, days).astype(float),
+        }, index=index.strftime('%Y-%m-%d'))
+        return frame.iloc[::-1], {'2. Symbol': symbol}
+
+async def start_sgs_server(latency):
+    # Responde a /dados/serie/bcdata.sgs.{série}/dados/ultimos/1 como a API do BCB
+    values = {str(main.SELIC_SERIES): "10.50", str(main.IPCA_SERIES): "4.20"}
+    counter = {'requests': 0}
+
+    async def last_value(request):
+        counter['requests'] += 1
+        await asyncio.sleep(latency)
+        series = request.match_info['series']
+        return web.json_response([{"data": datetime_label(), "valor": values.get(series, "1.00")}])
+
+    app = web.Application()
+    app.router.add_get('/dados/serie/bcdata.sgs.{series}/dados/ultimos/1', last_value)
+    server = TestServer(app, host='127.0.0.1')
+    await server.start_server()
+    return server, counter
+
+def datetime_label():
+    return time.strftime('%d/%m/%Y')
+
+# --- Medições ---
+
+class LoopLagMonitor:
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.samples = []
+        self._task = None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            expected = loop.time() + self.interval
+            await asyncio.sleep(self.interval)
+            self.samples.append(max(0.0, loop.time() - expected))
+
+    def __enter__(self):
+        self._task = asyncio.ensure_future(self._run())
+        return self
+
+    def __exit__(self, *exc):
+        self._task.cancel()
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(q * (len(ordered) - 1))))
+    return ordered[index]
+
+def summarize(name, latencies, wall_time, lag_samples, channels, failures):
+    calls = {'send': 0, 'edit': 0, 'file': 0}
+    for channel in channels:
+        for kind, count in channel.calls.items():
+            calls[kind] += count
+    runs = len(latencies)
+    return {
+        'scenario': name,
+        'runs': runs,
+        'failures': failures,
+        'throughput': runs / wall_time if wall_time else 0.0,
+        'p50': percentile(latencies, 0.5),
+        'p99': percentile(latencies, 0.99),
+        'mean': statistics.fmean(latencies) if latencies else 0.0,
+        'loop_lag_p99': percentile(lag_samples, 0.99),
+        'loop_lag_max': max(lag_samples, default=0.0),
+        'discord_calls_per_run': sum(calls.values()) / runs if runs else 0.0,
+        'discord_calls': calls,
+    }
+
+# --- Cenários ---
+
+channel_ids = itertools.count(10_000)
+
+async def run_users(name, users, make_run, discord_latency):
+    # Canais novos a cada cenário: o balde local de um cenário não afeta o próximo
+    channels = []
+    latencies = []
+    failures = 0
+
+    async def one(index):
+        nonlocal failures
+        channel = FakeChannel(next(channel_ids), discord_latency)
+        channels.append(channel)
+        ctx = FakeContext(channel, FakeAuthor(20_000 + index))
+        started_at = time.perf_counter()
+        try:
+            await make_run(index, ctx)
+        except Exception as e:
+            failures += 1
+            print(f"[{name}] usuário {index}: {type(e).__name__}: {e}")
+            return
+        latencies.append(time.perf_counter() - started_at)
+
+    with LoopLagMonitor() as monitor:
+        started_at = time.perf_counter()
+        await asyncio.gather(*(one(index) for index in range(users)))
+        wall_time = time.perf_counter() - started_at
+    return summarize(name, latencies, wall_time, monitor.samples, channels, failures)
+
+USER_REPLIES = [("valor total", None), ("taxa Selic", "10.50"), ("taxa IPCA", "4.20")]
+
+def investment_value(index):
+    # Valores em faixas distintas do cache de análises: a primeira rodada é
+    # sempre gerada e a segunda ('analisar_cache') sempre reaproveitada.
+    return round(1000 * 1.3 ** (index % 60) + index, 2)
+
+async def scenario_analisar(name, users, args):
+    async def run(index, ctx):
+        def reply(content):
+            # Também responde às perguntas de Selic/IPCA, feitas só se o SGS falhar
+            for question, answer in USER_REPLIES:
+                if question in content:
+                    message = FakeMessage(ctx.channel, answer or str(investment_value(index)), ctx.author)
+                    asyncio.get_running_loop().call_later(args.think_time, main.conversation_engine.dispatch, message)
+        ctx.channel.on_send = reply
+        await main.analyze_investment(ctx)
+    return await run_users(name, users, run, args.discord_latency)
+
+async def scenario_grafico_acao(name, users, args):
+    async def run(index, ctx):
+        symbol = SYMBOLS[index % len(SYMBOLS)]
+        options = CHART_OPTIONS[index % len(CHART_OPTIONS)]
+        await main.stock_chart(ctx, symbol, *options)
+    return await run_users(name, users, run, args.discord_latency)
+
+async def scenario_comparar(name, users, args):
+    async def run(index, ctx):
+        symbols = [SYMBOLS[(index + offset) % len(SYMBOLS)] for offset in range(3)]
+        await main.compare_stocks(ctx, *symbols)
+    return await run_users(name, users, run, args.discord_latency)
+
+SCENARIO_RUNNERS = {
+    'analisar': scenario_analisar,
+    'analisar_cache': scenario_analisar,
+    'grafico_acao': scenario_grafico_acao,
+    'comparar': scenario_comparar,
+}
+
+# --- Relatório ---
+
+def print_report(results):
+    header = f"{'cenário':<16}{'execuções':>10}{'falhas':>8}{'exec/s':>9}{'p50 (s)':>10}{'p99 (s)':>10}{'lag p99 (ms)':>14}{'lag máx (ms)':>14}{'chamadas/exec':>15}"
+    print(header)
+    print("-" * len(header))
+    for result in results:
+        print(f"{result['scenario']:<16}{result['runs']:>10}{result['failures']:>8}{result['throughput']:>9.1f}"
+              f"{result['p50']:>10.3f}{result['p99']:>10.3f}{result['loop_lag_p99'] * 1000:>14.1f}"
+              f"{result['loop_lag_max'] * 1000:>14.1f}{result['discord_calls_per_run']:>15.1f}")
+
+def compare_with_baseline(results, baseline_path, tolerance):
+    # Regressão: p99, atraso do loop ou chamadas ao Discord acima da tolerância
+    with open(baseline_path, encoding='utf-8') as f:
+        baseline = {result['scenario']: result for result in json.load(f)['results']}
+    regressions = []
+    for result in results:
+        previous = baseline.get(result['scenario'])
+        if previous is None:
+            continue
+        for key in ('p99', 'loop_lag_p99', 'discord_calls_per_run'):
+            # Pequenas variações absolutas (ruído do agendador) não contam
+            if result[key] > previous[key] * (1 + tolerance) and result[key] - previous[key] > 0.005:
+                regressions.append(f"{result['scenario']}: {key} {previous[key]:.3f} -> {result[key]:.3f}")
+        if result['failures'] > previous['failures']:
+            regressions.append(f"{result['scenario']}: falhas {previous['failures']} -> {result['failures']}")
+    return regressions
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark offline dos comandos do MoneyupInvestiments.")
+    parser.add_argument('--scenarios', nargs='+', choices=SCENARIOS, default=SCENARIOS)
+    parser.add_argument('--users', type=int, default=50, help="usuários simultâneos por cenário")
+    parser.add_argument('--gemini-latency', type=float, default=1.0, help="segundos até o primeiro pedaço da resposta")
+    parser.add_argument('--gemini-chunk-delay', type=float, default=0.05, help="segundos entre pedaços no streaming")
+    parser.add_argument('--no-streaming', action='store_true', help="gera a análise sem streaming")
+    parser.add_argument('--sgs-latency', type=float, default=0.1, help="latência do servidor SGS falso")
+    parser.add_argument('--alpha-vantage-latency', type=float, default=0.3, help="latência (bloqueante) da Alpha Vantage falsa")
+    parser.add_argument('--discord-latency', type=float, default=0.03, help="latência de cada chamada à API do Discord")
+    parser.add_argument('--think-time', type=float, default=0.2, help="tempo do usuário para responder ao bot")
+    parser.add_argument('--json', help="salva os resultados neste arquivo")
+    parser.add_argument('--baseline', help="compara com um resultado salvo por --json e falha se houver regressão")
+    parser.add_argument('--tolerance', type=float, default=0.2, help="piora relativa aceita em relação ao --baseline")
+    return parser.parse_args(argv)
+
+async def run_benchmark(args):
+    server, sgs_counter = await start_sgs_server(args.sgs_latency)
+    main.BCB_SGS_URL = f"http://{server.host}:{server.port}/dados/serie/bcdata.sgs.{{series}}/dados"
+    main.GEMINI_STREAMING = not args.no_streaming
+    model = FakeGenerativeModel(args.gemini_latency, args.gemini_chunk_delay)
+    main.generation_engine.model = model
+    main.alpha_vantage_client = FakeTimeSeries(args.alpha_vantage_latency)
+    await main.chart_renderer.warm_up()
+
+    results = []
+    try:
+        for name in args.scenarios:
+            result = await SCENARIO_RUNNERS[name](name, args.users, args)
+            results.append(result)
+            print(f"[{name}] concluído em {result['runs'] / result['throughput'] if result['throughput'] else 0:.2f}s")
+    finally:
+        await server.close()
+        await main.close_http_session()
+        main.user_session_data.close()
+        main.chart_renderer.shutdown()
+
+    upstream = {
+        'gemini': model.requests,
+        'alpha_vantage': main.alpha_vantage_client.requests,
+        'bcb_sgs': sgs_counter['requests'],
+    }
+    return results, upstream
+
+def run(argv=None):
+    args = parse_args(argv)
+    print(f"Benchmark com {args.users} usuários simultâneos por cenário (dados em {BENCHMARK_DIR}).")
+    results, upstream = asyncio.run(run_benchmark(args))
+    print()
+    print_report(results)
+    print(f"\nRequisições às dependências: Gemini {upstream['gemini']}, Alpha Vantage {upstream['alpha_vantage']}, BCB SGS {upstream['bcb_sgs']}")
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump({'args': vars(args), 'results': results, 'upstream': upstream}, f, indent=2, ensure_ascii=False)
+    if args.baseline:
+        regressions = compare_with_baseline(results, args.baseline, args.tolerance)
+        if regressions:
+            print("\nRegressões em relação ao baseline:")
+            for regression in regressions:
+                print(f"  - {regression}")
+            return 1
+        print("\nSem regressões em relação ao baseline.")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(run())
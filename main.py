@@ -1,15 +1,89 @@
+import time
+PROCESS_STARTED_AT = time.perf_counter()
+
 import discord
 from discord.ext import commands
-import google.generativeai as genai
 import os
+import sys
+import importlib
+import signal
+import subprocess
+import urllib.request
+import json
+import math
+import uuid
 import asyncio
 import aiohttp
-import pandas as pd
-import matplotlib.pyplot as plt
 import io
 import re
-from alpha_vantage.timeseries import TimeSeries
-from datetime import datetime # Importação adicionada para pegar o mês atual
+import hashlib
+import multiprocessing
+import sqlite3
+import threading
+import heapq
+import itertools
+import abc
+import functools
+import logging
+import contextlib
+import tempfile
+from aiohttp import web
+from collections import deque, OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime, date, timedelta # Importação adicionada para pegar o mês atual
+
+# --- Importações Sob Demanda ---
+# pandas, numpy e google.generativeai custam segundos e dezenas de MB para
+# importar. Eles só são carregados no primeiro uso (ou pelo aquecimento em segundo
+# plano depois da conexão), para que o bot conecte ao gateway o quanto antes.
+# matplotlib e alpha_vantage são importados dentro das funções que os usam.
+
+lazy_import_times = {}  # módulo -> segundos gastos na importação
+
+class LazyModule:
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def _load(self):
+        if self._module is None:
+            started_at = time.perf_counter()
+            self._module = importlib.import_module(self._name)
+            lazy_import_times[self._name] = time.perf_counter() - started_at
+        return self._module
+
+    @property
+    def loaded(self):
+        return self._module is not None
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+genai = LazyModule('google.generativeai')
+np = LazyModule('numpy')
+pd = LazyModule('pandas')
+LAZY_MODULES = [pd, np, genai]
+
+def load_lazy_modules():
+    for module in LAZY_MODULES:
+        module._load()
+
+def current_rss_mb():
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    import resource
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def startup_report(stage):
+    imports = ", ".join(f"{name} {seconds * 1000:.0f} ms" for name, seconds in lazy_import_times.items()) or "nenhuma"
+    print(f"[inicialização] {stage}: {time.perf_counter() - PROCESS_STARTED_AT:.2f}s desde o início, "
+          f"RSS {current_rss_mb():.0f} MB, importações sob demanda: {imports}")
 
 # --- Configurações Iniciais ---
 
@@ -17,131 +91,2846 @@ DISCORD_BOT_TOKEN = os.getenv('DISCORD_BOT_TOKEN')
 GEMINI_API_KEY = os.getenv('GEMINI_API_KEY')
 ALPHA_VANTAGE_API_KEY = os.getenv('ALPHA_VANTAGE_API_KEY')
 
-genai.configure(api_key=GEMINI_API_KEY)
-model = genai.GenerativeModel('gemini-1.5-flash')
+# Diretório dos arquivos locais (históricos, caches e sessões)
+DATA_DIR = os.getenv('DATA_DIR', 'data')
+
+# Modo de execução: 'single' (um shard), 'auto' (AutoShardedBot em um processo)
+# ou 'multi' (lançador com N processos, cada um dono de uma faixa de shards).
+# 'worker' é definido pelo próprio lançador para os processos filhos.
+BOT_SHARD_MODE = os.getenv('BOT_SHARD_MODE', 'single')
+SHARD_COUNT = int(os.getenv('SHARD_COUNT')) if os.getenv('SHARD_COUNT') else None
+SHARD_IDS = [int(shard_id) for shard_id in os.getenv('SHARD_IDS', '').split(',') if shard_id.strip()] or None
+SHARD_PROCESSES = int(os.getenv('SHARD_PROCESSES', str(os.cpu_count() or 1)))
+SHARD_HEALTH_INTERVAL = float(os.getenv('SHARD_HEALTH_INTERVAL', '30'))
+SHARED_STATE_PATH = os.getenv('SHARED_STATE_PATH', os.path.join(DATA_DIR, 'shared_state.db'))
+
+# Métricas: endpoint Prometheus local (porta 0 desativa) e amostragem do atraso do event loop
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+METRICS_PORT = int(os.getenv('METRICS_PORT', '0'))
+LOOP_LAG_INTERVAL = float(os.getenv('LOOP_LAG_INTERVAL', '0.5'))
+
+# Limites do motor de geração (Gemini)
+GEMINI_MAX_IN_FLIGHT = int(os.getenv('GEMINI_MAX_IN_FLIGHT', '3'))
+GEMINI_TIMEOUT = float(os.getenv('GEMINI_TIMEOUT', '90'))
+GEMINI_STREAMING = os.getenv('GEMINI_STREAMING', '1') == '1'
+
+# Tempo (segundos) que cada etapa da conversa aguarda a resposta do usuário
+CONVERSATION_TIMEOUT = float(os.getenv('CONVERSATION_TIMEOUT', '60'))
+
+# Armazenamento das sessões: 'memory' (padrão) ou 'sqlite' (sobrevive a reinícios
+# e pode ser compartilhado entre processos)
+SESSION_STORE = os.getenv('SESSION_STORE', 'sqlite' if BOT_SHARD_MODE == 'worker' else 'memory')
+SESSION_STORE_PATH = os.getenv('SESSION_STORE_PATH', os.path.join(DATA_DIR, 'sessions.db'))
+SESSION_TTL = float(os.getenv('SESSION_TTL', '1800'))
+SESSION_SWEEP_INTERVAL = float(os.getenv('SESSION_SWEEP_INTERVAL', '300'))
+
+# Intervalo mínimo (segundos) entre respostas automáticas do mesmo gatilho
+TRIGGER_CHANNEL_COOLDOWN = float(os.getenv('TRIGGER_CHANNEL_COOLDOWN', '30'))
+TRIGGER_USER_COOLDOWN = float(os.getenv('TRIGGER_USER_COOLDOWN', '120'))
+
+# Entrega de mensagens: balde local por canal e espera curta para agrupar envios
+DISCORD_CHANNEL_BURST = int(os.getenv('DISCORD_CHANNEL_BURST', '5'))
+DISCORD_CHANNEL_WINDOW = float(os.getenv('DISCORD_CHANNEL_WINDOW', '5'))
+DISCORD_OUTBOX_LINGER = float(os.getenv('DISCORD_OUTBOX_LINGER', '0.1'))
+
+# Pool HTTP compartilhado e cache dos indicadores do Banco Central (SGS)
+HTTP_POOL_SIZE = int(os.getenv('HTTP_POOL_SIZE', '20'))
+HTTP_TIMEOUT = float(os.getenv('HTTP_TIMEOUT', '15'))
+BCB_SGS_URL = os.getenv('BCB_SGS_URL', 'https://api.bcb.gov.br/dados/serie/bcdata.sgs.{series}/dados')
+SELIC_SERIES = 1178
+IPCA_SERIES = 13522
+INDICATOR_CACHE_TTL = float(os.getenv('INDICATOR_CACHE_TTL', '3600'))
+INDICATOR_CACHE_STALE_TTL = float(os.getenv('INDICATOR_CACHE_STALE_TTL', '86400'))
+
+# Histórico completo das séries do SGS (nome=código; 4389 = CDI anualizado)
+MACRO_SERIES = dict(
+    (name.strip().lower(), int(code)) for name, code in (
+        item.split('=', 1) for item in os.getenv('MACRO_SERIES', f'selic={SELIC_SERIES},ipca={IPCA_SERIES},cdi=4389').split(',') if '=' in item
+    )
+)
+MACRO_STORE_DIR = os.getenv('MACRO_STORE_DIR', os.path.join(DATA_DIR, 'macro'))
+MACRO_REFRESH_INTERVAL = float(os.getenv('MACRO_REFRESH_INTERVAL', '43200'))  # 12 horas
+
+# Orçamento da Alpha Vantage (plano gratuito: 5 requisições por minuto, 500 por dia)
+ALPHA_VANTAGE_PER_MINUTE = int(os.getenv('ALPHA_VANTAGE_PER_MINUTE', '5'))
+ALPHA_VANTAGE_PER_DAY = int(os.getenv('ALPHA_VANTAGE_PER_DAY', '500'))
+
+# Armazenamento local do histórico de preços
+PRICE_STORE_PATH = os.getenv('PRICE_STORE_PATH', os.path.join(DATA_DIR, 'prices.db'))
+PRICE_REFRESH_INTERVAL = float(os.getenv('PRICE_REFRESH_INTERVAL', '21600'))  # 6 horas
+STOCK_CHART_LOOKBACK = int(os.getenv('STOCK_CHART_LOOKBACK', '100'))
+
+# Renderização de gráficos (0 workers = uma thread no próprio processo)
+CHART_WORKERS = int(os.getenv('CHART_WORKERS', '2'))
+CHART_DPI = int(os.getenv('CHART_DPI', '100'))
+CHART_FORMAT = os.getenv('CHART_FORMAT', 'png')
+CHART_CACHE_SIZE = int(os.getenv('CHART_CACHE_SIZE', '128'))
+# Cache das análises geradas (ANALYSIS_CACHE_PATH vazio desativa a persistência em disco)
+ANALYSIS_CACHE_TTL = float(os.getenv('ANALYSIS_CACHE_TTL', '21600'))  # 6 horas
+ANALYSIS_CACHE_SIZE = int(os.getenv('ANALYSIS_CACHE_SIZE', '200'))
+ANALYSIS_CACHE_BUCKET = float(os.getenv('ANALYSIS_CACHE_BUCKET', '0.25'))  # largura relativa de cada faixa de valor
+ANALYSIS_CACHE_PATH = os.getenv('ANALYSIS_CACHE_PATH', os.path.join(DATA_DIR, 'analysis_cache.json'))
+INDICATOR_MEMO_SIZE = int(os.getenv('INDICATOR_MEMO_SIZE', '256'))
+COMPARE_MAX_SYMBOLS = int(os.getenv('COMPARE_MAX_SYMBOLS', '6'))
+
+# Projeção (Monte Carlo) da carteira sugerida. Os proxies são lidos apenas do
+# histórico local (inclua-os em PREFETCH_SYMBOLS para mantê-los atualizados).
+PROJECTION_YEARS = int(os.getenv('PROJECTION_YEARS', '5'))
+PROJECTION_PATHS = int(os.getenv('PROJECTION_PATHS', '20000'))
+PROJECTION_BUDGET = float(os.getenv('PROJECTION_BUDGET', '3'))  # segundos
+PROJECTION_WORKERS = int(os.getenv('PROJECTION_WORKERS', '0'))  # 0 = threads no próprio processo
+PROJECTION_PROXIES = dict(
+    item.strip().split('=', 1) for item in os.getenv('PROJECTION_PROXIES', 'acoes=BOVA11.SA,fii=HGLG11.SA').split(',') if '=' in item
+)
+
+# Tarefas em segundo plano: atualização de indicadores e pré-busca de símbolos populares
+INDICATOR_REFRESH_INTERVAL = float(os.getenv('INDICATOR_REFRESH_INTERVAL', '1800'))
+PREFETCH_SYMBOLS = [symbol.strip().upper() for symbol in os.getenv('PREFETCH_SYMBOLS', '').split(',') if symbol.strip()]
+PREFETCH_INTERVAL = float(os.getenv('PREFETCH_INTERVAL', '3600'))
+PREFETCH_RESERVE = int(os.getenv('PREFETCH_RESERVE', '100'))  # requisições diárias reservadas aos usuários
+
+def create_generation_model():
+    genai.configure(api_key=GEMINI_API_KEY)
+    return genai.GenerativeModel('gemini-1.5-flash')
+
+# --- Métricas ---
+# Histogramas de latência, gauges de chamadas em andamento e contadores de erro
+# para comandos, dependências externas, renderização de gráficos e chamadas à API
+# do Discord. Expostos em /metrics (formato Prometheus) e no comando !status.
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        index = 0
+        while index < len(self.buckets) and value > self.buckets[index]:
+            index += 1
+        self.counts[index] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q):
+        # Aproximação pelo limite superior do bucket que contém o quantil
+        if not self.count:
+            return None
+        target = q * self.count
+        cumulative = 0
+        for index, count in enumerate(self.counts):
+            cumulative += count
+            if cumulative >= target:
+                return self.buckets[index] if index < len(self.buckets) else math.inf
+        return math.inf
+
+class Metrics:
+    def __init__(self):
+        self.histograms = {}  # (nome, rótulos) -> Histogram
+        self.gauges = {}  # (nome, rótulos) -> valor
+        self.counters = {}  # (nome, rótulos) -> valor
+        self.collectors = []  # funções que devolvem {(nome, rótulos): valor} no momento da leitura
+        self.started_at = time.time()
+
+    @staticmethod
+    def _key(metric, labels):
+        return (metric, tuple(sorted(labels.items())))
+
+    def observe(self, metric, value, **labels):
+        key = self._key(metric, labels)
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = Histogram()
+        histogram.observe(value)
+
+    def inc(self, metric, amount=1, **labels):
+        key = self._key(metric, labels)
+        self.counters[key] = self.counters.get(key, 0) + amount
+
+    def set_gauge(self, metric, value, **labels):
+        self.gauges[self._key(metric, labels)] = value
+
+    def add_gauge(self, metric, amount, **labels):
+        key = self._key(metric, labels)
+        self.gauges[key] = self.gauges.get(key, 0) + amount
+
+    @contextlib.contextmanager
+    def track(self, kind, name):
+        # Mede uma operação: moneyup_<kind>_seconds, _in_flight e _errors_total
+        self.add_gauge(f"moneyup_{kind}_in_flight", 1, name=name)
+        started_at = time.perf_counter()
+        try:
+            yield
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            self.inc(f"moneyup_{kind}_errors_total", name=name)
+            raise
+        finally:
+            self.observe(f"moneyup_{kind}_seconds", time.perf_counter() - started_at, name=name)
+            self.add_gauge(f"moneyup_{kind}_in_flight", -1, name=name)
+
+    def histogram(self, metric, **labels):
+        return self.histograms.get(self._key(metric, labels))
+
+    def histograms_named(self, metric):
+        return {dict(labels).get('name', ''): histogram for (key, labels), histogram in self.histograms.items() if key == metric}
+
+    def collected(self):
+        values = {}
+        for collector in self.collectors:
+            try:
+                values.update(collector())
+            except Exception as e:
+                print(f"Erro ao coletar métricas: {e}")
+        return values
+
+    def render_prometheus(self):
+        def fmt_labels(labels, extra=()):
+            items = list(labels) + list(extra)
+            if not items:
+                return ""
+            return "{" + ",".join(f'{key}="{str(value).replace(chr(34), "")}"' for key, value in items) + "}"
+
+        lines = []
+        for (name, labels), histogram in sorted(self.histograms.items()):
+            cumulative = 0
+            for bound, count in zip(histogram.buckets, histogram.counts):
+                cumulative += count
+                lines.append(f"{name}_bucket{fmt_labels(labels, [('le', bound)])} {cumulative}")
+            lines.append(f"{name}_bucket{fmt_labels(labels, [('le', '+Inf')])} {histogram.count}")
+            lines.append(f"{name}_sum{fmt_labels(labels)} {histogram.sum}")
+            lines.append(f"{name}_count{fmt_labels(labels)} {histogram.count}")
+        for (name, labels), value in sorted(self.counters.items()):
+            lines.append(f"{name}{fmt_labels(labels)} {value}")
+        gauges = dict(self.gauges)
+        gauges.update(self.collected())
+        for (name, labels), value in sorted(gauges.items()):
+            if value is not None:
+                lines.append(f"{name}{fmt_labels(labels)} {value}")
+        lines.append(f"moneyup_uptime_seconds {time.time() - self.started_at}")
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+
+async def sample_loop_lag():
+    # Quanto uma tarefa agendada atrasa além do previsto: mede o bloqueio do event loop
+    loop = asyncio.get_running_loop()
+    while True:
+        expected = loop.time() + LOOP_LAG_INTERVAL
+        await asyncio.sleep(LOOP_LAG_INTERVAL)
+        lag = max(0.0, loop.time() - expected)
+        metrics.observe("moneyup_event_loop_lag_seconds", lag)
+        metrics.set_gauge("moneyup_event_loop_lag_last_seconds", lag)
+
+def instrument_discord_http(http):
+    # Todas as chamadas REST do discord.py passam por HTTPClient.request
+    original_request = http.request
+
+    async def request(route, **kwargs):
+        with metrics.track('discord', f"{route.method} {route.path}"):
+            return await original_request(route, **kwargs)
+
+    http.request = request
+
+async def handle_metrics(request):
+    return web.Response(text=metrics.render_prometheus(), content_type='text/plain', charset='utf-8')
+
+async def start_metrics_server():
+    if not METRICS_PORT:
+        return None
+    app = web.Application()
+    app.router.add_get('/metrics', handle_metrics)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, METRICS_HOST, METRICS_PORT).start()
+    print(f"Métricas disponíveis em http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+    return runner
 
 intents = discord.Intents.default()
 intents.message_content = True
 intents.members = True
 
-bot = commands.Bot(command_prefix='!', intents=intents)
+class MoneyupBotMixin:
+    metrics_runner = None
+
+    async def setup_hook(self):
+        await get_http_session()
+        instrument_discord_http(self.http)
+        self.loop.create_task(sample_loop_lag())
+        self.loop.create_task(sweep_sessions())
+        self.loop.create_task(report_shard_health())
+        try:
+            self.metrics_runner = await start_metrics_server()
+        except OSError as e:
+            print(f"Não foi possível iniciar o endpoint de métricas: {e}")
+
+    async def close(self):
+        background_scheduler.stop()
+        if self.metrics_runner is not None:
+            await self.metrics_runner.cleanup()
+        await super().close()
+        await close_http_session()
+        chart_renderer.shutdown()
+        projection_engine.shutdown()
+        user_session_data.close()
+
+    def shard_latencies(self):
+        return [(self.shard_id or 0, self.latency)]
+
+class MoneyupBot(MoneyupBotMixin, commands.Bot):
+    pass
+
+class MoneyupShardedBot(MoneyupBotMixin, commands.AutoShardedBot):
+    def shard_latencies(self):
+        return self.latencies
+
+if BOT_SHARD_MODE in ('auto', 'worker'):
+    bot = MoneyupShardedBot(command_prefix='!', intents=intents, shard_count=SHARD_COUNT, shard_ids=SHARD_IDS)
+else:
+    bot = MoneyupBot(command_prefix='!', intents=intents)
+
+# --- Estado Compartilhado entre Processos ---
+# No modo 'multi' cada processo tem seus próprios caches em memória; o que
+# precisa ser global (orçamento da Alpha Vantage, indicadores do BCB e a saúde
+# dos shards) passa por um arquivo SQLite em modo WAL.
+
+class SharedState:
+    def __init__(self, path):
+        self.path = path
+        self._conn = None
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        if self._conn is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            conn = sqlite3.connect(self.path, check_same_thread=False, timeout=5.0, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript("""
+                CREATE TABLE IF NOT EXISTS kv (key TEXT PRIMARY KEY, value TEXT, updated_at REAL NOT NULL);
+                CREATE TABLE IF NOT EXISTS buckets (
+                    name TEXT PRIMARY KEY, tokens REAL NOT NULL, refilled_at REAL NOT NULL,
+                    day TEXT NOT NULL, used INTEGER NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS shard_health (
+                    shard_id INTEGER PRIMARY KEY, pid INTEGER, latency REAL, guilds INTEGER, updated_at REAL NOT NULL
+                );
+            """)
+            self._conn = conn
+        return self._conn
+
+    def get_value(self, key, max_age):
+        with self._lock:
+            row = self._connect().execute("SELECT value, updated_at FROM kv WHERE key = ?", (key,)).fetchone()
+        if row is None or time.time() - row[1] >= max_age:
+            return None
+        return json.loads(row[0])
+
+    def set_value(self, key, value):
+        with self._lock:
+            self._connect().execute("INSERT OR REPLACE INTO kv VALUES (?, ?, ?)", (key, json.dumps(value), time.time()))
+
+    def acquire_lease(self, key, ttl):
+        # Exclusão entre processos: o lease vale até ser liberado ou expirar após `ttl` segundos
+        now = time.time()
+        owner = os.getpid()
+        with self._lock:
+            conn = self._connect()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = conn.execute("SELECT value, updated_at FROM kv WHERE key = ?", (key,)).fetchone()
+                granted = row is None or json.loads(row[0]) == owner or now - row[1] >= ttl
+                if granted:
+                    conn.execute("INSERT OR REPLACE INTO kv VALUES (?, ?, ?)", (key, json.dumps(owner), now))
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        return granted
+
+    def release_lease(self, key):
+        with self._lock:
+            self._connect().execute("DELETE FROM kv WHERE key = ? AND value = ?", (key, json.dumps(os.getpid())))
+
+    def take_token(self, name, per_minute, per_day):
+        # Token bucket global: devolve (concedido, segundos até o próximo token, restante hoje)
+        now = time.time()
+        today = date.today().isoformat()
+        with self._lock:
+            conn = self._connect()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = conn.execute("SELECT tokens, refilled_at, day, used FROM buckets WHERE name = ?", (name,)).fetchone()
+                tokens, refilled_at, day, used = row if row else (float(per_minute), now, today, 0)
+                tokens = min(per_minute, tokens + (now - refilled_at) * per_minute / 60.0)
+                if day != today:
+                    day, used = today, 0
+                granted = tokens >= 1 and used < per_day
+                if granted:
+                    tokens -= 1
+                    used += 1
+                conn.execute("INSERT OR REPLACE INTO buckets VALUES (?, ?, ?, ?, ?)", (name, tokens, now, day, used))
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        wait = 0.0 if tokens >= 1 else (1 - tokens) * 60.0 / per_minute
+        return granted, wait, per_day - used
+
+    def report_shard(self, shard_id, latency, guilds):
+        with self._lock:
+            self._connect().execute("INSERT OR REPLACE INTO shard_health VALUES (?, ?, ?, ?, ?)",
+                                    (shard_id, os.getpid(), latency, guilds, time.time()))
+
+    def shard_report(self):
+        with self._lock:
+            return self._connect().execute("SELECT shard_id, pid, latency, guilds, updated_at FROM shard_health ORDER BY shard_id").fetchall()
+
+shared_state = SharedState(SHARED_STATE_PATH) if BOT_SHARD_MODE == 'worker' else None
+
+def shard_guild_counts():
+    counts = {}
+    for guild in bot.guilds:
+        counts[guild.shard_id] = counts.get(guild.shard_id, 0) + 1
+    return counts
+
+async def report_shard_health():
+    await bot.wait_until_ready()
+    while not bot.is_closed():
+        counts = shard_guild_counts()
+        for shard_id, latency in bot.shard_latencies():
+            latency = latency if math.isfinite(latency) else None
+            if latency is not None and latency > 1.0:
+                print(f"Shard {shard_id}: latência alta no gateway ({latency * 1000:.0f} ms).")
+            if shared_state is not None:
+                try:
+                    await asyncio.to_thread(shared_state.report_shard, shard_id, latency, counts.get(shard_id, 0))
+                except Exception as e:
+                    print(f"Erro ao registrar a saúde do shard {shard_id}: {e}")
+        await asyncio.sleep(SHARD_HEALTH_INTERVAL)
+
+# --- Lançador de Shards (modo 'multi') ---
+
+def fetch_recommended_shard_count():
+    request = urllib.request.Request("https://discord.com/api/v10/gateway/bot",
+                                     headers={'Authorization': f"Bot {DISCORD_BOT_TOKEN}", 'User-Agent': 'MoneyupInvestiments'})
+    with urllib.request.urlopen(request, timeout=15) as response:
+        return json.load(response)['shards']
+
+def split_shards(shard_count, processes):
+    # Faixas contíguas de shards, o mais equilibradas possível
+    processes = max(1, min(processes, shard_count))
+    size, extra = divmod(shard_count, processes)
+    ranges, start = [], 0
+    for index in range(processes):
+        end = start + size + (1 if index < extra else 0)
+        ranges.append(list(range(start, end)))
+        start = end
+    return ranges
+
+def run_shard_launcher():
+    shard_count = SHARD_COUNT or fetch_recommended_shard_count()
+    ranges = split_shards(shard_count, SHARD_PROCESSES)
+    print(f"Iniciando {shard_count} shard(s) em {len(ranges)} processo(s): {ranges}")
+
+    def start_worker(shard_ids):
+        env = dict(os.environ, BOT_SHARD_MODE='worker', SHARD_COUNT=str(shard_count),
+                   SHARD_IDS=','.join(str(shard_id) for shard_id in shard_ids))
+        return subprocess.Popen([sys.executable, os.path.abspath(__file__)], env=env)
+
+    workers = {}
+    stopping = False
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    for index, shard_ids in enumerate(ranges):
+        if index:
+            # O Discord só aceita uma identificação a cada ~5 s: escalona os processos
+            time.sleep(5.5 * len(ranges[index - 1]))
+        workers[index] = (start_worker(shard_ids), 1.0)
+
+    while not stopping:
+        time.sleep(1)
+        for index, (process, backoff) in list(workers.items()):
+            if process.poll() is not None and not stopping:
+                print(f"Processo dos shards {ranges[index]} terminou (código {process.returncode}); reiniciando em {backoff:.0f}s.")
+                time.sleep(backoff)
+                workers[index] = (start_worker(ranges[index]), min(backoff * 2, 60.0))
+
+    for process, _ in workers.values():
+        if process.poll() is None:
+            process.terminate()
+    for process, _ in workers.values():
+        try:
+            process.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+# --- Motor de Conversas ---
+
+class ConversationCancelled(Exception):
+    pass
+
+class TimerWheel:
+    # Um único relógio para todos os prazos das conversas: os prazos caem em
+    # fatias de `resolution` segundos, verificadas por uma só task.
+    def __init__(self, resolution=1.0):
+        self.resolution = resolution
+        self._slots = {}  # fatia -> {chave: callback}
+        self._deadlines = {}  # chave -> fatia
+        self._task = None
+
+    def _tick(self, moment):
+        return math.ceil(moment / self.resolution)
+
+    def schedule(self, key, delay, callback):
+        self.cancel(key)
+        tick = self._tick(time.monotonic() + delay)
+        self._slots.setdefault(tick, {})[key] = callback
+        self._deadlines[key] = tick
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self._run())
+
+    def cancel(self, key):
+        tick = self._deadlines.pop(key, None)
+        if tick is not None:
+            slot = self._slots.get(tick)
+            if slot is not None:
+                slot.pop(key, None)
+                if not slot:
+                    del self._slots[tick]
+
+    def __len__(self):
+        return len(self._deadlines)
+
+    async def _run(self):
+        while self._slots:
+            await asyncio.sleep(self.resolution)
+            now = self._tick(time.monotonic())
+            for tick in sorted(tick for tick in self._slots if tick <= now):
+                for key, callback in self._slots.pop(tick).items():
+                    self._deadlines.pop(key, None)
+                    callback()
+
+class ConversationEngine:
+    # Cada sessão aberta espera no máximo uma resposta, indexada por
+    # (canal, autor): uma mensagem recebida é entregue em O(1) a no máximo uma
+    # sessão, sem avaliar um `check` por conversa pendente.
+    def __init__(self, wheel):
+        self.wheel = wheel
+        self._waiting = {}  # chave -> (parser, future)
+
+    async def expect(self, key, parser, timeout, ready=None):
+        future = asyncio.get_running_loop().create_future()
+        self._waiting[key] = (parser, future)
+        try:
+            if ready is not None:
+                # A resposta já é aceita, mas o prazo só corre depois que a pergunta
+                # sai da fila de mensagens (ver MessageOutbox)
+                await ready
+            if not future.done():
+                self.wheel.schedule(key, timeout, lambda: self._resolve(key, future, exception=asyncio.TimeoutError()))
+            return await future
+        finally:
+            if key in self._waiting and self._waiting[key][1] is future:
+                del self._waiting[key]
+                self.wheel.cancel(key)
+
+    def dispatch(self, message):
+        key = (message.channel.id, message.author.id)
+        entry = self._waiting.get(key)
+        if entry is None:
+            return False
+        parser, future = entry
+        try:
+            value = parser(message.content)
+        except ValueError:
+            return False
+        self._resolve(key, future, result=value)
+        return True
+
+    def cancel(self, key):
+        entry = self._waiting.get(key)
+        if entry is None:
+            return False
+        self._resolve(key, entry[1], exception=ConversationCancelled())
+        return True
+
+    def _resolve(self, key, future, result=None, exception=None):
+        if self._waiting.get(key, (None, None))[1] is future:
+            del self._waiting[key]
+            self.wheel.cancel(key)
+        if future.done():
+            return
+        if exception is not None:
+            future.set_exception(exception)
+        else:
+            future.set_result(result)
+
+    @property
+    def waiting(self):
+        return len(self._waiting)
+
+class AnalysisSession:
+    AWAITING_VALUE = 'awaiting_value'
+    SELIC = 'selic'
+    IPCA = 'ipca'
+    GENERATING = 'generating'
+    DONE = 'done'
+
+    def __init__(self, channel_id, author_id):
+        self.channel_id = channel_id
+        self.author_id = author_id
+        self.state = self.AWAITING_VALUE
+        self.investment_value = None
+        self.selic = None
+        self.ipca = None
+        self.market_perception = None
+        self.session_id = uuid.uuid4().hex
+        self.created_at = time.time()
+        self.updated_at = self.created_at
+        self._indicators_task = None
+
+    @property
+    def key(self):
+        return (self.channel_id, self.author_id)
+
+    def to_record(self):
+        # Registro compacto gravado pelos backends persistentes
+        return json.dumps({
+            'id': self.session_id, 's': self.state, 'v': self.investment_value,
+            'se': self.selic, 'ip': self.ipca, 'c': self.created_at,
+        }, separators=(',', ':'))
+
+    @classmethod
+    def from_record(cls, channel_id, author_id, record, updated_at):
+        data = json.loads(record)
+        session = cls(channel_id, author_id)
+        session.session_id = data['id']
+        session.state = data['s']
+        session.investment_value = data['v']
+        session.selic = data['se']
+        session.ipca = data['ip']
+        session.created_at = data['c']
+        session.updated_at = updated_at
+        return session
+
+    def fetch_indicators(self):
+        if self._indicators_task is None:
+            self._indicators_task = asyncio.ensure_future(get_indicators())
+        return self._indicators_task
+
+# float() aceita 'nan' e 'inf'; respostas assim são ignoradas como qualquer texto inválido
+def parse_amount(text):
+    value = float(text)
+    if not math.isfinite(value) or value <= 0:
+        raise ValueError(text)
+    return value
+
+def parse_rate(text):
+    value = float(text)
+    if not math.isfinite(value):
+        raise ValueError(text)
+    return value
+
+CONVERSATION_TIMEOUTS = {
+    AnalysisSession.AWAITING_VALUE: CONVERSATION_TIMEOUT,
+    AnalysisSession.SELIC: CONVERSATION_TIMEOUT,
+    AnalysisSession.IPCA: CONVERSATION_TIMEOUT,
+}
+
+conversation_engine = ConversationEngine(TimerWheel())
+
+# --- Armazenamento de Sessões ---
+
+class SessionStore(abc.ABC):
+    # Interface comum dos backends. `delete` recebe o id da sessão para não apagar
+    # uma sessão mais nova que tenha substituído a antiga na mesma chave.
+    @abc.abstractmethod
+    async def get(self, key):
+        ...
+
+    @abc.abstractmethod
+    async def put(self, session):
+        ...
+
+    @abc.abstractmethod
+    async def delete(self, key, session_id=None):
+        ...
+
+    @abc.abstractmethod
+    async def by_author(self, author_id):
+        ...
+
+    @abc.abstractmethod
+    async def all(self):
+        ...
+
+    @abc.abstractmethod
+    async def sweep(self, ttl):
+        ...
+
+    def close(self):
+        pass
+
+class MemorySessionStore(SessionStore):
+    def __init__(self):
+        self._sessions = {}
+
+    async def get(self, key):
+        return self._sessions.get(key)
+
+    async def put(self, session):
+        session.updated_at = time.time()
+        self._sessions[session.key] = session
+
+    async def delete(self, key, session_id=None):
+        session = self._sessions.get(key)
+        if session is not None and (session_id is None or session.session_id == session_id):
+            del self._sessions[key]
+
+    async def by_author(self, author_id):
+        return [session for session in self._sessions.values() if session.author_id == author_id]
+
+    async def all(self):
+        return list(self._sessions.values())
+
+    async def sweep(self, ttl):
+        cutoff = time.time() - ttl
+        expired = [key for key, session in self._sessions.items() if session.updated_at < cutoff]
+        for key in expired:
+            del self._sessions[key]
+        return len(expired)
+
+    def __len__(self):
+        return len(self._sessions)
+
+class SQLiteSessionStore(SessionStore):
+    # SQLite em modo WAL: vários processos (shards) podem ler e gravar o mesmo
+    # arquivo, e as sessões sobrevivem a um reinício do worker.
+    def __init__(self, path):
+        self.path = path
+        self._conn = None
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        if self._conn is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            conn = sqlite3.connect(self.path, check_same_thread=False, timeout=5.0)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS sessions (
+                    channel_id INTEGER NOT NULL,
+                    author_id INTEGER NOT NULL,
+                    record TEXT NOT NULL,
+                    updated_at REAL NOT NULL,
+                    PRIMARY KEY (channel_id, author_id)
+                ) WITHOUT ROWID
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS sessions_author ON sessions (author_id)")
+            conn.execute("CREATE INDEX IF NOT EXISTS sessions_updated ON sessions (updated_at)")
+            self._conn = conn
+        return self._conn
+
+    def _execute(self, query, params=(), fetch=False):
+        with self._lock:
+            conn = self._connect()
+            with conn:
+                cursor = conn.execute(query, params)
+                return cursor.fetchall() if fetch else cursor.rowcount
+
+    def _sessions(self, rows):
+        return [AnalysisSession.from_record(*row) for row in rows]
+
+    async def get(self, key):
+        rows = await asyncio.to_thread(self._execute, "SELECT channel_id, author_id, record, updated_at FROM sessions WHERE channel_id = ? AND author_id = ?", key, True)
+        return self._sessions(rows)[0] if rows else None
+
+    async def put(self, session):
+        session.updated_at = time.time()
+        await asyncio.to_thread(self._execute, "INSERT OR REPLACE INTO sessions VALUES (?, ?, ?, ?)",
+                                (session.channel_id, session.author_id, session.to_record(), session.updated_at))
+
+    async def delete(self, key, session_id=None):
+        if session_id is None:
+            await asyncio.to_thread(self._execute, "DELETE FROM sessions WHERE channel_id = ? AND author_id = ?", key)
+        else:
+            await asyncio.to_thread(self._execute, "DELETE FROM sessions WHERE channel_id = ? AND author_id = ? AND json_extract(record, '$.id') = ?",
+                                    (*key, session_id))
+
+    async def by_author(self, author_id):
+        rows = await asyncio.to_thread(self._execute, "SELECT channel_id, author_id, record, updated_at FROM sessions WHERE author_id = ?", (author_id,), True)
+        return self._sessions(rows)
+
+    async def all(self):
+        rows = await asyncio.to_thread(self._execute, "SELECT channel_id, author_id, record, updated_at FROM sessions", (), True)
+        return self._sessions(rows)
+
+    async def sweep(self, ttl):
+        return await asyncio.to_thread(self._execute, "DELETE FROM sessions WHERE updated_at < ?", (time.time() - ttl,))
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
 
-user_session_data = {}
+def create_session_store():
+    if SESSION_STORE == 'sqlite':
+        return SQLiteSessionStore(SESSION_STORE_PATH)
+    return MemorySessionStore()
+
+user_session_data = create_session_store()  # (channel_id, author_id) -> AnalysisSession
+analysis_tasks = {}  # sessões sendo conduzidas por este processo: chave -> task
+
+async def sweep_sessions():
+    while True:
+        await asyncio.sleep(SESSION_SWEEP_INTERVAL)
+        try:
+            expired = await user_session_data.sweep(SESSION_TTL)
+            if expired:
+                print(f"{expired} sessão(ões) expirada(s) removida(s).")
+        except Exception as e:
+            print(f"Erro ao limpar sessões expiradas: {e}")
+
+# --- Motor de Geração (Gemini) ---
+
+class GenerationCancelled(Exception):
+    pass
+
+class GenerationEngine:
+    # Executa as chamadas ao Gemini sem bloquear o event loop, com no máximo
+    # `max_in_flight` gerações simultâneas e uma fila FIFO para o excedente.
+    def __init__(self, model=None, max_in_flight=3, timeout=90.0, model_factory=None):
+        self._model = model
+        self.model_factory = model_factory
+        self.max_in_flight = max(1, max_in_flight)
+        self.timeout = timeout
+        self._in_flight = 0
+        self._waiting = deque()  # (user_id, future) aguardando vaga
+        self._jobs = {}  # user_id -> task da geração em andamento
+        self._cancelled = set()  # tasks canceladas por `cancel` (não por timeout ou desligamento)
+
+    @property
+    def model(self):
+        # O modelo (e a importação do google.generativeai) só é criado no primeiro uso
+        if self._model is None and self.model_factory is not None:
+            self._model = self.model_factory()
+        return self._model
+
+    @model.setter
+    def model(self, model):
+        self._model = model
+
+    @property
+    def in_flight(self):
+        return self._in_flight
+
+    @property
+    def queued(self):
+        return len(self._waiting)
+
+    def queue_position(self, user_id):
+        for position, (waiting_user, _) in enumerate(self._waiting, start=1):
+            if waiting_user == user_id:
+                return position
+        return None
+
+    async def _acquire(self, user_id, on_queued=None):
+        if self._in_flight < self.max_in_flight and not self._waiting:
+            self._in_flight += 1
+            return
+        slot = asyncio.get_running_loop().create_future()
+        self._waiting.append((user_id, slot))
+        if on_queued:
+            await on_queued(len(self._waiting))
+        try:
+            await slot
+        except asyncio.CancelledError:
+            if slot.done() and not slot.cancelled():
+                # A vaga já tinha sido repassada para nós; devolve para o próximo.
+                self._release()
+            else:
+                try:
+                    self._waiting.remove((user_id, slot))
+                except ValueError:
+                    pass
+            raise
+
+    def _release(self):
+        while self._waiting:
+            _, slot = self._waiting.popleft()
+            if not slot.done():
+                slot.set_result(None)  # a vaga passa direto para o próximo da fila
+                return
+        self._in_flight -= 1
+
+    async def _generate(self, prompt, on_chunk):
+        with metrics.track('dependency', 'gemini'):
+            if on_chunk is None:
+                response = await self.model.generate_content_async(prompt)
+                return response.text
+            # Modo streaming: repassa cada pedaço assim que o modelo o produz.
+            parts = []
+            started_at = time.perf_counter()
+            response = await self.model.generate_content_async(prompt, stream=True)
+            async for chunk in response:
+                text = chunk.text
+                if text:
+                    if not parts:
+                        metrics.observe("moneyup_gemini_first_chunk_seconds", time.perf_counter() - started_at)
+                    parts.append(text)
+                    await on_chunk(text)
+            return "".join(parts)
+
+    async def _run(self, user_id, prompt, on_queued, on_chunk):
+        await self._acquire(user_id, on_queued)
+        try:
+            return await asyncio.wait_for(self._generate(prompt, on_chunk), timeout=self.timeout)
+        finally:
+            self._release()
+
+    async def generate(self, user_id, prompt, on_queued=None, on_chunk=None):
+        self.cancel(user_id)
+        job = asyncio.ensure_future(self._run(user_id, prompt, on_queued, on_chunk))
+        self._jobs[user_id] = job
+        try:
+            return await job
+        except asyncio.CancelledError:
+            if job in self._cancelled and job.cancelled():
+                raise GenerationCancelled()
+            raise
+        finally:
+            if self._jobs.get(user_id) is job:
+                del self._jobs[user_id]
+            self._cancelled.discard(job)
+
+    def cancel(self, user_id):
+        job = self._jobs.get(user_id)
+        if job is None or job.done():
+            return False
+        self._cancelled.add(job)
+        job.cancel()
+        return True
+
+generation_engine = GenerationEngine(model_factory=create_generation_model, max_in_flight=GEMINI_MAX_IN_FLIGHT, timeout=GEMINI_TIMEOUT)
 
 # --- Funções Auxiliares (APIs e Geração de Gráficos) ---
 
-async def get_selic_rate():
+http_session = None
+
+async def get_http_session():
+    # Uma única sessão (e pool de conexões) durante toda a vida do bot
+    global http_session
+    if http_session is None or http_session.closed:
+        http_session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=HTTP_POOL_SIZE, ttl_dns_cache=300),
+            timeout=aiohttp.ClientTimeout(total=HTTP_TIMEOUT),
+        )
+    return http_session
+
+async def close_http_session():
+    global http_session
+    if http_session is not None and not http_session.closed:
+        await http_session.close()
+    http_session = None
+
+class IndicatorCache:
+    # Cache com TTL para indicadores que mudam no máximo uma vez por dia.
+    # Dentro de `ttl` o valor é servido direto; até `stale_ttl` o valor antigo é
+    # servido enquanto uma atualização roda em segundo plano. Requisições
+    # simultâneas para a mesma chave compartilham uma única busca.
+    def __init__(self, ttl=3600.0, stale_ttl=86400.0, shared=None):
+        self.ttl = ttl
+        self.stale_ttl = max(ttl, stale_ttl)
+        self.shared = shared
+        self._entries = {}  # chave -> (valor, momento da busca)
+        self._pending = {}  # chave -> task da busca em andamento
+        self.hits = 0
+        self.misses = 0
+        self.upstream_requests = 0
+
+    async def get(self, key, fetcher):
+        entry = self._entries.get(key)
+        if entry is not None:
+            value, fetched_at = entry
+            age = time.monotonic() - fetched_at
+            if age < self.ttl:
+                self.hits += 1
+                return value
+            if age < self.stale_ttl:
+                self.hits += 1
+                self._refresh(key, fetcher)
+                return value
+        self.misses += 1
+        # shield: um chamador cancelado não cancela a busca dos demais
+        return await asyncio.shield(self._refresh(key, fetcher))
+
+    async def refresh(self, key, fetcher):
+        # Atualização forçada (usada pelo agendador em segundo plano)
+        return await asyncio.shield(self._refresh(key, fetcher))
+
+    def _refresh(self, key, fetcher):
+        task = self._pending.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._fetch(key, fetcher))
+            self._pending[key] = task
+        return task
+
+    async def _fetch(self, key, fetcher):
+        try:
+            if self.shared is not None:
+                # Outro processo pode já ter buscado este indicador
+                value = await asyncio.to_thread(self.shared.get_value, f"indicator:{key}", self.ttl)
+                if value is not None:
+                    self._entries[key] = (value, time.monotonic())
+                    return value
+            self.upstream_requests += 1
+            value = await fetcher()
+            if value is not None:
+                self._entries[key] = (value, time.monotonic())
+                if self.shared is not None:
+                    await asyncio.to_thread(self.shared.set_value, f"indicator:{key}", value)
+                return value
+            # Falhou: usa o último valor conhecido, se houver
+            entry = self._entries.get(key)
+            return entry[0] if entry is not None else None
+        finally:
+            self._pending.pop(key, None)
+
+indicator_cache = IndicatorCache(ttl=INDICATOR_CACHE_TTL, stale_ttl=INDICATOR_CACHE_STALE_TTL, shared=shared_state)
+
+async def fetch_sgs_last_value(series, label):
     try:
-        url = "https://api.bcb.gov.br/dados/serie/bcdata.sgs.1178/dados/ultimos/1?formato=json"
-        async with aiohttp.ClientSession() as session:
+        url = BCB_SGS_URL.format(series=series) + "/ultimos/1?formato=json"
+        session = await get_http_session()
+        with metrics.track('dependency', f"bcb_sgs_{series}"):
             async with session.get(url) as response:
                 if response.status == 200:
-                    data = await response.json()
+                    data = await response.json(content_type=None)
                     if data:
                         return data[0]['valor']
+                metrics.inc("moneyup_dependency_errors_total", name=f"bcb_sgs_{series}")
                 return None
     except Exception as e:
-        print(f"Erro ao buscar Selic: {e}")
+        print(f"Erro ao buscar {label}: {e}")
         return None
 
+INDICATOR_FETCHERS = {
+    'selic': lambda: fetch_sgs_last_value(SELIC_SERIES, "Selic"),
+    'ipca': lambda: fetch_sgs_last_value(IPCA_SERIES, "IPCA"),
+}
+
+async def get_selic_rate():
+    with metrics.track('dependency', 'selic'):
+        return await indicator_cache.get('selic', INDICATOR_FETCHERS['selic'])
+
 async def get_ipca_rate():
+    with metrics.track('dependency', 'ipca'):
+        return await indicator_cache.get('ipca', INDICATOR_FETCHERS['ipca'])
+
+async def get_indicators():
+    # Busca Selic e IPCA em paralelo
+    return await asyncio.gather(get_selic_rate(), get_ipca_rate())
+
+class QuotaExceeded(Exception):
+    pass
+
+class AlphaVantageScheduler:
+    # Ponto único de acesso à Alpha Vantage. Um token bucket respeita os limites
+    # por minuto e por dia, pedidos idênticos em andamento são unificados e a
+    # fila é atendida por prioridade (menor número primeiro) e ordem de chegada.
+    PRIORITY_USER = 0
+    PRIORITY_BACKGROUND = 10
+    SHARED_TOKEN_RETRIES = 8
+
+    def __init__(self, per_minute=5, per_day=500, shared=None):
+        self.per_minute = max(1, per_minute)
+        self.per_day = per_day
+        self.shared = shared  # orçamento global entre processos (modo 'multi')
+        self._shared_remaining = per_day
+        self._tokens = float(self.per_minute)
+        self._last_refill = time.monotonic()
+        self._day = date.today()
+        self._used_today = 0
+        self._heap = []  # (prioridade, sequência, chave)
+        self._jobs = {}  # chave -> pedido pendente ou em execução
+        self._seq = itertools.count()
+        self._wakeup = None
+        self._worker = None
+        self.requests_made = 0
+        self.coalesced = 0
+        self.rejected = 0
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.per_minute, self._tokens + (now - self._last_refill) * self.per_minute / 60.0)
+        self._last_refill = now
+        if date.today() != self._day:
+            self._day = date.today()
+            self._used_today = 0
+
+    def remaining_minute(self):
+        self._refill()
+        return int(self._tokens)
+
+    def remaining_today(self):
+        self._refill()
+        remaining = self.per_day - self._used_today
+        if self.shared is not None:
+            remaining = min(remaining, self._shared_remaining)
+        return max(0, remaining)
+
+    @property
+    def queued(self):
+        return sum(1 for job in self._jobs.values() if not job['started'])
+
+    def queue_position(self, key):
+        job = self._jobs.get(key)
+        if job is None or job['started']:
+            return None
+        ahead = sum(1 for other in self._jobs.values()
+                    if not other['started'] and (other['priority'], other['seq']) < (job['priority'], job['seq']))
+        return ahead + 1
+
+    def estimated_wait(self, position):
+        # Segundos até o pedido na posição `position` receber um token
+        self._refill()
+        missing = position - self._tokens
+        return max(0.0, missing * 60.0 / self.per_minute)
+
+    def stats(self):
+        return {
+            'remaining_minute': self.remaining_minute(),
+            'remaining_today': self.remaining_today(),
+            'queued': self.queued,
+            'requests_made': self.requests_made,
+            'coalesced': self.coalesced,
+            'rejected': self.rejected,
+        }
+
+    async def submit(self, key, call, priority=PRIORITY_USER, on_queued=None):
+        job = self._jobs.get(key)
+        if job is not None:
+            self.coalesced += 1
+            if not job['started'] and priority < job['priority']:
+                job['priority'] = priority
+                heapq.heappush(self._heap, (priority, job['seq'], key))
+        else:
+            if self.remaining_today() - self.queued <= 0:
+                self.rejected += 1
+                raise QuotaExceeded(f"Limite diário de {self.per_day} requisições da Alpha Vantage atingido.")
+            job = {
+                'future': asyncio.get_running_loop().create_future(),
+                'call': call,
+                'priority': priority,
+                'seq': next(self._seq),
+                'started': False,
+            }
+            self._jobs[key] = job
+            heapq.heappush(self._heap, (priority, job['seq'], key))
+            self._ensure_worker()
+            self._wakeup.set()
+
+        position = self.queue_position(key)
+        if on_queued and position is not None and self.estimated_wait(position) > 0:
+            await on_queued(position, self.estimated_wait(position))
+        # shield: se quem pediu desistir, o resultado ainda serve aos demais
+        return await asyncio.shield(job['future'])
+
+    def _ensure_worker(self):
+        if self._wakeup is None:
+            self._wakeup = asyncio.Event()
+        if self._worker is None or self._worker.done():
+            self._worker = asyncio.ensure_future(self._run_worker())
+
+    def _next_job(self):
+        while self._heap:
+            priority, seq, key = heapq.heappop(self._heap)
+            job = self._jobs.get(key)
+            # Entradas antigas (reprioritizadas ou já iniciadas) são ignoradas
+            if job is not None and not job['started'] and job['seq'] == seq and job['priority'] == priority:
+                return key, job
+        return None, None
+
+    async def _run_worker(self):
+        while True:
+            if not self._heap:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            self._refill()
+            if self._tokens < 1:
+                await asyncio.sleep((1 - self._tokens) * 60.0 / self.per_minute)
+                continue
+            key, job = self._next_job()
+            if job is None:
+                continue
+            try:
+                await self._dispatch(key, job)
+            except Exception as e:
+                # O pedido já saiu do heap: responde com o erro em vez de derrubar o worker
+                print(f"Erro no agendador da Alpha Vantage: {e}")
+                self._finish(key, job, exception=e)
+
+    async def _dispatch(self, key, job):
+        if self.shared is not None:
+            try:
+                granted, wait, self._shared_remaining = await asyncio.to_thread(
+                    self.shared.take_token, 'alpha_vantage', self.per_minute, self.per_day)
+            except sqlite3.OperationalError as e:
+                # Banco compartilhado bloqueado por outro processo: o pedido volta à
+                # fila com backoff e só falha depois de SHARED_TOKEN_RETRIES tentativas
+                job['token_failures'] = job.get('token_failures', 0) + 1
+                if job['token_failures'] >= self.SHARED_TOKEN_RETRIES:
+                    raise
+                print(f"Orçamento compartilhado indisponível ({e}); nova tentativa em instantes.")
+                heapq.heappush(self._heap, (job['priority'], job['seq'], key))
+                await asyncio.sleep(min(5.0, 0.1 * 2 ** job['token_failures']))
+                return
+            if not granted and self._shared_remaining > 0:
+                # Outro processo usou o token: devolve o pedido à fila e espera
+                heapq.heappush(self._heap, (job['priority'], job['seq'], key))
+                await asyncio.sleep(wait)
+                return
+        job['started'] = True
+        # Um token concedido pelo orçamento compartilhado já foi descontado do dia
+        # (_shared_remaining é o saldo depois dele): conferir de novo recusaria o último
+        shared_granted = self.shared is not None and granted
+        if not shared_granted and self.remaining_today() <= 0:
+            self.rejected += 1
+            self._finish(key, job, exception=QuotaExceeded(f"Limite diário de {self.per_day} requisições da Alpha Vantage atingido."))
+            return
+        self._tokens -= 1
+        self._used_today += 1
+        self.requests_made += 1
+        asyncio.ensure_future(self._execute(key, job))
+
+    async def _execute(self, key, job):
+        try:
+            with metrics.track('dependency', 'alpha_vantage'):
+                result = await asyncio.to_thread(job['call'])
+        except Exception as e:
+            self._finish(key, job, exception=e)
+        else:
+            self._finish(key, job, result=result)
+
+    def _finish(self, key, job, result=None, exception=None):
+        if self._jobs.get(key) is job:
+            del self._jobs[key]
+        if job['future'].done():
+            return
+        if exception is not None:
+            job['future'].set_exception(exception)
+        else:
+            job['future'].set_result(result)
+
+alpha_vantage_scheduler = AlphaVantageScheduler(per_minute=ALPHA_VANTAGE_PER_MINUTE, per_day=ALPHA_VANTAGE_PER_DAY, shared=shared_state)
+alpha_vantage_client = None
+
+def get_alpha_vantage_client():
+    global alpha_vantage_client
+    if alpha_vantage_client is None:
+        from alpha_vantage.timeseries import TimeSeries
+        alpha_vantage_client = TimeSeries(key=ALPHA_VANTAGE_API_KEY, output_format='pandas')
+    return alpha_vantage_client
+
+class PriceStore:
+    # Histórico diário de preços por símbolo em SQLite. A primeira consulta faz o
+    # backfill completo; as seguintes regravam a última barra salva e acrescentam as mais novas.
+    COLUMNS = ['open', 'high', 'low', 'close', 'volume']
+
+    def __init__(self, path):
+        self.path = path
+        self._conn = None
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        if self._conn is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            conn = sqlite3.connect(self.path, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript("""
+                CREATE TABLE IF NOT EXISTS prices (
+                    symbol TEXT NOT NULL,
+                    day TEXT NOT NULL,
+                    open REAL, high REAL, low REAL, close REAL, volume REAL,
+                    PRIMARY KEY (symbol, day)
+                ) WITHOUT ROWID;
+                CREATE TABLE IF NOT EXISTS price_meta (
+                    symbol TEXT PRIMARY KEY,
+                    last_day TEXT,
+                    checked_at REAL NOT NULL
+                );
+            """)
+            self._conn = conn
+        return self._conn
+
+    def meta(self, symbol):
+        with self._lock:
+            row = self._connect().execute(
+                "SELECT last_day, checked_at FROM price_meta WHERE symbol = ?", (symbol,)
+            ).fetchone()
+        if row is None:
+            return None
+        return {'last_day': row[0], 'checked_at': row[1]}
+
+    def load(self, symbol, since=None):
+        query = "SELECT day, open, high, low, close, volume FROM prices WHERE symbol = ?"
+        params = [symbol]
+        if since is not None:
+            query += " AND day >= ?"
+            params.append(since)
+        with self._lock:
+            rows = self._connect().execute(query + " ORDER BY day", params).fetchall()
+        frame = pd.DataFrame(rows, columns=['day'] + self.COLUMNS)
+        frame.index = pd.to_datetime(frame.pop('day'))
+        return frame
+
+    def append(self, symbol, frame):
+        rows = [
+            (symbol, day.strftime('%Y-%m-%d'), *(None if pd.isna(v) else float(v) for v in values))
+            for day, values in zip(frame.index, frame[self.COLUMNS].itertuples(index=False))
+        ]
+        with self._lock:
+            conn = self._connect()
+            with conn:
+                conn.executemany("INSERT OR REPLACE INTO prices VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+                conn.execute(
+                    "INSERT INTO price_meta (symbol, last_day, checked_at) "
+                    "VALUES (?, (SELECT MAX(day) FROM prices WHERE symbol = ?), ?) "
+                    "ON CONFLICT(symbol) DO UPDATE SET last_day = excluded.last_day, checked_at = excluded.checked_at",
+                    (symbol, symbol, time.time()),
+                )
+        return len(rows)
+
+price_store = PriceStore(PRICE_STORE_PATH)
+
+async def fetch_daily_prices(symbol, outputsize, priority=AlphaVantageScheduler.PRIORITY_USER, on_queued=None):
+    ts = get_alpha_vantage_client()
+    data, meta_data = await alpha_vantage_scheduler.submit(
+        ('daily', symbol, outputsize),
+        lambda: ts.get_daily(symbol=symbol, outputsize=outputsize),
+        priority=priority,
+        on_queued=on_queued,
+    )
+    data = data.copy()
+    data.columns = [col.split('. ')[1] for col in data.columns]
+    data.index = pd.to_datetime(data.index)
+    return data.sort_index()
+
+# 'outputsize=full' é recurso pago: a recusa vale para a chave, não para o símbolo.
+# Lembrada por FULL_HISTORY_RECHECK (entre processos via shared_state), evita
+# gastar duas requisições por símbolo novo em chaves gratuitas.
+FULL_HISTORY_RECHECK = 86400.0
+full_history_refused_at = None
+
+def is_premium_refusal(error):
+    # A biblioteca usa ValueError também para símbolo inválido ('Error Message')
+    # e para o limite de requisições ('Note'); só a recusa do 'full' é tratada aqui.
+    message = str(error).lower()
+    return 'outputsize=full' in message or 'premium feature' in message
+
+async def full_history_available():
+    if full_history_refused_at is not None and time.time() - full_history_refused_at < FULL_HISTORY_RECHECK:
+        return False
+    if shared_state is not None:
+        return not await asyncio.to_thread(shared_state.get_value, 'alpha_vantage_full_refused', FULL_HISTORY_RECHECK)
+    return True
+
+async def remember_full_history_refused():
+    global full_history_refused_at
+    full_history_refused_at = time.time()
+    if shared_state is not None:
+        await asyncio.to_thread(shared_state.set_value, 'alpha_vantage_full_refused', True)
+
+async def update_price_history(symbol, meta, priority=AlphaVantageScheduler.PRIORITY_USER, on_queued=None):
+    last_day = pd.Timestamp(meta['last_day']) if meta and meta['last_day'] else None
+    # 'compact' traz ~100 pregões; lacunas maiores (ou o primeiro acesso) pedem o histórico completo
+    if (last_day is not None and pd.Timestamp.now() - last_day < timedelta(days=140)) or not await full_history_available():
+        data = await fetch_daily_prices(symbol, 'compact', priority, on_queued)
+    else:
+        try:
+            data = await fetch_daily_prices(symbol, 'full', priority, on_queued)
+        except ValueError as e:
+            if not is_premium_refusal(e):
+                raise
+            print(f"Histórico completo indisponível nesta chave ({e}); usando 'compact'.")
+            await remember_full_history_refused()
+            data = await fetch_daily_prices(symbol, 'compact', priority, on_queued)
+    if last_day is not None:
+        # '>=': a última barra salva pode ser parcial (consulta durante o pregão) e é regravada
+        data = data[data.index >= last_day]
+    await asyncio.to_thread(price_store.append, symbol, data)
+
+async def get_price_history(symbol, priority=AlphaVantageScheduler.PRIORITY_USER, on_queued=None, refresh=True):
+    meta = await asyncio.to_thread(price_store.meta, symbol)
+    stale = meta is None or time.time() - meta['checked_at'] >= PRICE_REFRESH_INTERVAL
+    if refresh and stale:
+        if not ALPHA_VANTAGE_API_KEY:
+            print("ALPHA_VANTAGE_API_KEY não configurada.")
+        else:
+            try:
+                await update_price_history(symbol, meta, priority, on_queued)
+            except Exception as e:
+                # Sem acesso à API: o histórico já salvo (se houver) continua servindo
+                print(f"Erro ao buscar dados da ação {symbol} na Alpha Vantage: {e}")
+    return await asyncio.to_thread(price_store.load, symbol)
+
+async def get_stock_data(symbol, lookback=STOCK_CHART_LOOKBACK, priority=AlphaVantageScheduler.PRIORITY_USER, on_queued=None):
     try:
-        url = "https://api.bcb.gov.br/dados/serie/bcdata.sgs.13522/dados/ultimos/1?formato=json"
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url) as response:
-                if response.status == 200:
-                    data = await response.json()
-                    if data:
-                        return data[0]['valor']
-                return None
+        with metrics.track('dependency', 'stock_data'):
+            data = await get_price_history(symbol, priority=priority, on_queued=on_queued)
     except Exception as e:
-        print(f"Erro ao buscar IPCA: {e}")
+        print(f"Erro ao ler o histórico local de {symbol}: {e}")
         return None
-
-async def get_stock_data(symbol):
-    if not ALPHA_VANTAGE_API_KEY:
-        print("ALPHA_VANTAGE_API_KEY não configurada.")
+    if data.empty:
         return None
-
-    try:
-        ts = TimeSeries(key=ALPHA_VANTAGE_API_KEY, output_format='pandas')
-        data, meta_data = await asyncio.to_thread(ts.get_daily, symbol=symbol, outputsize='compact')
-        data.columns = [col.split('. ')[1] for col in data.columns]
-        data.index = pd.to_datetime(data.index)
-        data = data.sort_index()
-        return data['4. close']
-    except Exception as e:
-        print(f"Erro ao buscar dados da ação {symbol} na Alpha Vantage: {e}")
+    close = data['close'].dropna()
+    return close.tail(lookback) if lookback else close
+
+# --- Séries Macroeconômicas (BCB SGS) ---
+# Histórico completo das séries do SGS guardado em colunas (datas e valores)
+# num arquivo .npz por série. A carga inicial baixa janelas de 10 anos (limite
+# da API para séries diárias) em paralelo; depois só as datas novas são pedidas.
+
+MACRO_FIRST_YEAR = 1980
+MACRO_WINDOW_YEARS = 10
+MACRO_LEASE_TTL = 300.0  # segundos que um worker pode segurar a atualização de uma série
+MACRO_SERIES_LABELS = {'selic': "Selic", 'ipca': "IPCA (12 meses)", 'cdi': "CDI"}
+
+class MacroSeriesStore:
+    def __init__(self, directory):
+        self.directory = directory
+        self._loaded = {}  # nome -> (mtime, datas, valores, checked_at)
+
+    def _path(self, name):
+        return os.path.join(self.directory, f"{name}.npz")
+
+    def load(self, name):
+        # Devolve (datas datetime64[D], valores float64, checked_at) ou None
+        path = self._path(name)
+        try:
+            mtime = os.path.getmtime(path)
+        except OSError:
+            return None
+        cached = self._loaded.get(name)
+        if cached is None or cached[0] != mtime:
+            with np.load(path) as data:
+                cached = (mtime, data['dates'], data['values'], float(data['checked_at']))
+            self._loaded[name] = cached
+        return cached[1:]
+
+    def save(self, name, dates, values, checked_at):
+        os.makedirs(self.directory, exist_ok=True)
+        # Temporário exclusivo: dois processos gravando a mesma série não se atropelam
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, prefix=f"{name}.", suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.savez(f, dates=dates.astype('datetime64[D]'), values=values.astype('float64'), checked_at=np.float64(checked_at))
+            os.replace(tmp_path, self._path(name))
+        except BaseException:
+            with contextlib.suppress(OSError):
+                os.remove(tmp_path)
+            raise
+
+    def append(self, name, dates, values, checked_at):
+        current = self.load(name)
+        if current is not None:
+            old_dates, old_values, _ = current
+            keep = dates > old_dates[-1] if len(old_dates) else slice(None)
+            dates = np.concatenate([old_dates, dates[keep]])
+            values = np.concatenate([old_values, values[keep]])
+        self.save(name, dates, values, checked_at)
+
+class MacroSeriesEngine:
+    def __init__(self, store, series, refresh_interval=43200.0, shared=None):
+        self.store = store
+        self.series = series  # nome -> código SGS
+        self.refresh_interval = refresh_interval
+        self.shared = shared  # no modo 'multi', só um worker baixa cada série
+        self._pending = {}  # nome -> task da atualização em andamento
+        self.upstream_requests = 0
+
+    @staticmethod
+    def _parse(records):
+        if not records:
+            return np.array([], dtype='datetime64[D]'), np.array([], dtype='float64')
+        dates = pd.to_datetime([record['data'] for record in records], format='%d/%m/%Y').to_numpy().astype('datetime64[D]')
+        values = pd.to_numeric(pd.Series([record['valor'] for record in records]), errors='coerce').to_numpy(dtype='float64')
+        valid = ~np.isnan(values)
+        return dates[valid], values[valid]
+
+    async def _fetch_window(self, code, start, end):
+        url = BCB_SGS_URL.format(series=code)
+        params = {'formato': 'json', 'dataInicial': start.strftime('%d/%m/%Y'), 'dataFinal': end.strftime('%d/%m/%Y')}
+        session = await get_http_session()
+        self.upstream_requests += 1
+        with metrics.track('dependency', f"bcb_sgs_{code}_historico"):
+            async with session.get(url, params=params) as response:
+                # 404: nenhum dado no período (ex.: antes do início da série)
+                if response.status == 404:
+                    return []
+                response.raise_for_status()
+                return await response.json(content_type=None)
+
+    def _windows(self, start, end):
+        windows = []
+        while start <= end:
+            window_end = min((pd.Timestamp(start) + pd.DateOffset(years=MACRO_WINDOW_YEARS)).date() - timedelta(days=1), end)
+            windows.append((start, window_end))
+            start = window_end + timedelta(days=1)
+        return windows
+
+    async def _is_fresh(self, name):
+        current = await asyncio.to_thread(self.store.load, name)
+        return current is not None and time.time() - current[2] < self.refresh_interval
+
+    async def _update(self, name, force=False):
+        if self.shared is None:
+            await self._download(name)
+            return
+        lease = f"macro_refresh:{name}"
+        while not await asyncio.to_thread(self.shared.acquire_lease, lease, MACRO_LEASE_TTL):
+            # Outro worker está baixando a série: espera e reaproveita o arquivo que ele gravar
+            await asyncio.sleep(1.0)
+            if await self._is_fresh(name):
+                return
+        try:
+            # Quem segurava o lease pode ter acabado de gravar a série
+            if force or not await self._is_fresh(name):
+                await self._download(name)
+        finally:
+            await asyncio.to_thread(self.shared.release_lease, lease)
+
+    async def _download(self, name):
+        code = self.series[name]
+        current = await asyncio.to_thread(self.store.load, name)
+        today = date.today()
+        if current is not None and len(current[0]):
+            start = current[0][-1].astype(date) + timedelta(days=1)
+        else:
+            start = date(MACRO_FIRST_YEAR, 1, 1)
+        windows = self._windows(start, today)
+        results = await asyncio.gather(*(self._fetch_window(code, window_start, window_end) for window_start, window_end in windows))
+        records = [record for result in results for record in result]
+        dates, values = self._parse(records)
+        order = np.argsort(dates, kind='stable')
+        await asyncio.to_thread(self.store.append, name, dates[order], values[order], time.time())
+        if len(dates):
+            print(f"Série {name} (SGS {code}): {len(dates)} novas observações.")
+
+    async def refresh(self, name, force=False):
+        # Atualizações simultâneas da mesma série compartilham uma única busca
+        if not force and await self._is_fresh(name):
+            return
+        pending = self._pending.get(name)
+        if pending is None:
+            pending = asyncio.ensure_future(self._update(name, force))
+            self._pending[name] = pending
+            pending.add_done_callback(lambda _: self._pending.pop(name, None))
+        await asyncio.shield(pending)
+
+    async def refresh_all(self):
+        await asyncio.gather(*(self.refresh(name) for name in self.series))
+
+    async def get(self, name, since=None):
+        try:
+            await self.refresh(name)
+        except Exception as e:
+            # Sem acesso ao SGS: o histórico já salvo (se houver) continua servindo
+            print(f"Erro ao atualizar a série {name} no SGS: {e}")
+        current = await asyncio.to_thread(self.store.load, name)
+        if current is None:
+            return None
+        dates, values, _ = current
+        if since is not None:
+            first = np.searchsorted(dates, np.datetime64(since, 'D'))
+            dates, values = dates[first:], values[first:]
+        return pd.Series(values, index=pd.DatetimeIndex(dates), name=name)
+
+macro_engine = MacroSeriesEngine(MacroSeriesStore(MACRO_STORE_DIR), MACRO_SERIES, refresh_interval=MACRO_REFRESH_INTERVAL, shared=shared_state)
+
+def monthly(series):
+    # Último valor de cada mês: alinha séries diárias (Selic, CDI) às mensais (IPCA)
+    return series.resample('MS').last().dropna()
+
+def real_interest_rate(selic, ipca):
+    # Juro real ex-post: (1 + Selic) / (1 + IPCA 12 meses) - 1, em % a.a.
+    frame = pd.concat([monthly(selic), monthly(ipca)], axis=1, join='inner').dropna()
+    if frame.empty:
+        return pd.Series(dtype='float64')
+    values = frame.to_numpy(dtype='float64') / 100
+    return pd.Series(((1 + values[:, 0]) / (1 + values[:, 1]) - 1) * 100, index=frame.index, name='juro_real')
+
+PERIOD_PATTERN = re.compile(r"^(\d+)\s*(a|anos?|m|meses|mes|mês|d|dias?)$")
+
+def parse_period(text):
+    # '5a', '18m', '90d' ou 'max' -> data inicial (None = histórico inteiro)
+    text = text.strip().lower()
+    if text in ('max', 'tudo'):
         return None
-
-async def generate_line_chart(data_series, title="Gráfico de Preço", ylabel="Preço (R$)"):
+    match = PERIOD_PATTERN.match(text)
+    if not match:
+        raise ValueError(text)
+    amount, unit = int(match.group(1)), match.group(2)[0]
+    today = pd.Timestamp.today().normalize()
+    offset = {'a': pd.DateOffset(years=amount), 'm': pd.DateOffset(months=amount), 'd': pd.DateOffset(days=amount)}[unit]
+    return (today - offset).date()
+
+# As funções render_* rodam nos processos do pool: recebem apenas dados simples
+# (picklable), usam a API orientada a objetos do matplotlib (sem o estado global
+# do pyplot) e devolvem os bytes da imagem.
+
+def _save_figure(fig, spec):
+    buf = io.BytesIO()
+    fig.savefig(buf, format=spec['format'], dpi=spec['dpi'], transparent=True)
+    return buf.getvalue()
+
+def render_line_chart(spec):
+    import matplotlib.style
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+    panels = spec.get('panels', [])
+    with matplotlib.style.context('dark_background'):
+        fig = Figure(figsize=(12, 6 + 2 * len(panels)))
+        FigureCanvasAgg(fig)
+        axes = fig.subplots(1 + len(panels), 1, sharex=True, squeeze=False,
+                            gridspec_kw={'height_ratios': [3] + [1] * len(panels)})[:, 0]
+        ax = axes[0]
+        for band in spec.get('bands', []):
+            ax.fill_between(spec['x'], band['lower'], band['upper'], color=band.get('color', 'gray'), alpha=0.2, label=band['label'])
+        for line in spec['lines']:
+            ax.plot(spec['x'], line['y'], color=line.get('color'), label=line.get('label'),
+                    marker=line.get('marker'), markersize=2, linewidth=line.get('linewidth', 1.5))
+        ax.set_ylabel(spec['ylabel'], color='white')
+        ax.set_title(spec['title'], color='white')
+        if any(line.get('label') for line in spec['lines']) or spec.get('bands'):
+            ax.legend(loc='best', fontsize='small')
+        for panel_ax, panel in zip(axes[1:], panels):
+            for line in panel['lines']:
+                panel_ax.plot(spec['x'], line['y'], color=line.get('color'), label=line.get('label'), linewidth=1)
+            for level in panel.get('hlines', []):
+                panel_ax.axhline(level, color='gray', linestyle=':', linewidth=1)
+            panel_ax.set_ylabel(panel['title'], color='white')
+        for axis in axes:
+            axis.tick_params(axis='y', colors='white')
+            axis.grid(True, linestyle='--', alpha=0.7)
+        axes[-1].set_xlabel("Data", color='white')
+        axes[-1].tick_params(axis='x', labelrotation=45, colors='white')
+        for label in axes[-1].get_xticklabels():
+            label.set_horizontalalignment('right')
+        fig.tight_layout()
+        return _save_figure(fig, spec)
+
+def render_pie_chart(spec):
+    import matplotlib
+    import matplotlib.style
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+    with matplotlib.style.context('dark_background'):
+        fig = Figure(figsize=(10, 8))
+        FigureCanvasAgg(fig)
+        ax = fig.add_subplot()
+        colors = matplotlib.colormaps['Paired'](range(len(spec['labels'])))
+        ax.pie(spec['sizes'], labels=spec['labels'], colors=colors, autopct='', startangle=90, wedgeprops={'edgecolor': 'white'})
+        ax.axis('equal')
+        ax.set_title(spec['title'], color='white')
+        return _save_figure(fig, spec)
+
+def _warm_up_chart_worker():
+    # Carrega o matplotlib e o cache de fontes no processo do pool
+    render_line_chart({'x': [0, 1], 'lines': [{'y': [0, 1]}], 'title': '', 'ylabel': '', 'format': 'png', 'dpi': 10})
+    return True
+
+class LRUCache:
+    # Cache LRU em memória: imagens renderizadas (endereçadas pelo conteúdo do
+    # gráfico), indicadores técnicos e projeções. None indica ausência.
+    def __init__(self, max_entries=128):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        data = self._entries.get(key)
+        if data is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return data
+
+    def put(self, key, data):
+        self._entries[key] = data
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self._entries)
+
+class ChartRenderer:
+    def __init__(self, workers=2, cache_size=128, dpi=100, image_format='png'):
+        self.workers = workers
+        self.dpi = dpi
+        self.format = image_format
+        self.cache = LRUCache(cache_size)
+        self._executor = None
+        self._pending = {}
+
+    def _get_executor(self):
+        if self._executor is None:
+            if self.workers > 0:
+                # 'spawn' evita herdar o estado do event loop e das threads do bot
+                self._executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context('spawn'))
+            else:
+                self._executor = ThreadPoolExecutor(max_workers=1)
+        return self._executor
+
+    def cache_key(self, kind, content_key):
+        raw = repr((kind, content_key, self.dpi, self.format)).encode('utf-8')
+        return hashlib.sha256(raw).hexdigest()
+
+    async def render(self, render_func, spec, content_key):
+        key = self.cache_key(render_func.__name__, content_key)
+        data = self.cache.get(key)
+        if data is not None:
+            return data
+        # Pedidos simultâneos do mesmo gráfico compartilham uma única renderização
+        pending = self._pending.get(key)
+        if pending is None:
+            spec = dict(spec, dpi=self.dpi, format=self.format)
+            pending = asyncio.ensure_future(self._render(render_func, spec))
+            self._pending[key] = pending
+            pending.add_done_callback(lambda _: self._pending.pop(key, None))
+        data = await asyncio.shield(pending)
+        self.cache.put(key, data)
+        return data
+
+    def _reset_executor(self, executor):
+        # Só descarta o pool se ninguém já o tiver trocado por um novo
+        if self._executor is executor:
+            self._executor = None
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    async def _render(self, render_func, spec):
+        loop = asyncio.get_running_loop()
+        with metrics.track('chart', render_func.__name__):
+            for attempt in range(2):
+                executor = self._get_executor()
+                try:
+                    return await loop.run_in_executor(executor, render_func, spec)
+                except BrokenProcessPool:
+                    # Um worker morreu (ex.: OOM) e o pool não aceita mais tarefas:
+                    # recria o pool e tenta mais uma vez
+                    print("Pool de renderização de gráficos quebrado; recriando.")
+                    self._reset_executor(executor)
+                    if attempt:
+                        raise
+
+    async def warm_up(self):
+        loop = asyncio.get_running_loop()
+        executor = self._get_executor()
+        await asyncio.gather(*(loop.run_in_executor(executor, _warm_up_chart_worker) for _ in range(max(1, self.workers))))
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+chart_renderer = ChartRenderer(workers=CHART_WORKERS, cache_size=CHART_CACHE_SIZE, dpi=CHART_DPI, image_format=CHART_FORMAT)
+
+def series_content_key(data_series):
+    # Identifica a série pelo conteúdo quando quem chama não informa uma chave
+    digest = hashlib.sha256(data_series.index.to_numpy().tobytes())
+    digest.update(data_series.to_numpy(dtype='float64').tobytes())
+    return digest.hexdigest()
+
+def _aligned_values(series, index):
+    return series.reindex(index).to_numpy(dtype='float64')
+
+async def generate_line_chart(data_series, title="Gráfico de Preço", ylabel="Preço (R$)", cache_key=None,
+                              overlays=None, bands=None, panels=None):
     if data_series is None or data_series.empty:
         return None
 
-    plt.style.use('dark_background')
-    plt.figure(figsize=(12, 6))
-    data_series.plot(kind='line', color='cyan', marker='o', markersize=2)
-    plt.xlabel("Data", color='white')
-    plt.ylabel(ylabel, color='white')
-    plt.title(title, color='white')
-    plt.xticks(rotation=45, ha='right', color='white')
-    plt.yticks(color='white')
-    plt.grid(True, linestyle='--', alpha=0.7)
-    plt.tight_layout()
+    # overlays: [(rótulo, série)], bands: [(rótulo, inferior, superior)],
+    # panels: [(título, [(rótulo, série)], linhas horizontais)]
+    index = data_series.index
+    main_line = {'y': data_series.to_numpy(dtype='float64'), 'color': 'cyan', 'marker': 'o'}
+    if overlays or bands:
+        main_line['label'] = "Fechamento"
+    spec = {
+        'x': index.to_numpy(),
+        'lines': [main_line] + [
+            {'y': _aligned_values(series, index), 'label': label, 'linewidth': 1.2}
+            for label, series in (overlays or [])
+        ],
+        'bands': [
+            {'label': label, 'lower': _aligned_values(lower, index), 'upper': _aligned_values(upper, index)}
+            for label, lower, upper in (bands or [])
+        ],
+        'panels': [
+            {'title': panel_title, 'lines': [{'y': _aligned_values(series, index), 'label': label} for label, series in lines], 'hlines': list(hlines)}
+            for panel_title, lines, hlines in (panels or [])
+        ],
+        'title': title,
+        'ylabel': ylabel,
+    }
+    content_key = (cache_key if cache_key is not None else series_content_key(data_series), title, ylabel)
+    data = await chart_renderer.render(render_line_chart, spec, content_key)
+    return discord.File(io.BytesIO(data), filename=f"price_chart.{chart_renderer.format}")
 
-    buf = io.BytesIO()
-    plt.savefig(buf, format='png', transparent=True)
-    buf.seek(0)
-    plt.close()
-    return discord.File(buf, filename="price_chart.png")
+async def generate_comparison_chart(normalized, title="Comparação de Retornos", cache_key=None):
+    if normalized is None or normalized.empty:
+        return None
+
+    spec = {
+        'x': normalized.index.to_numpy(),
+        'lines': [{'y': normalized[column].to_numpy(dtype='float64'), 'label': column} for column in normalized.columns],
+        'title': title,
+        'ylabel': "Base 100",
+    }
+    if cache_key is None:
+        cache_key = tuple(series_content_key(normalized[column]) for column in normalized.columns)
+    data = await chart_renderer.render(render_line_chart, spec, (cache_key, title))
+    return discord.File(io.BytesIO(data), filename=f"comparison_chart.{chart_renderer.format}")
 
 async def generate_pie_chart(allocations, title="Sugestão de Alocação da Carteira"):
     if not allocations:
         return None
 
-    labels = [f"{k} ({v:.1f}%)" for k, v in allocations.items()]
-    sizes = list(allocations.values())
-    colors = plt.cm.Paired(range(len(labels)))
+    spec = {
+        'labels': [f"{k} ({v:.1f}%)" for k, v in allocations.items()],
+        'sizes': list(allocations.values()),
+        'title': title,
+    }
+    content_key = (tuple(allocations.items()), title)
+    data = await chart_renderer.render(render_pie_chart, spec, content_key)
+    return discord.File(io.BytesIO(data), filename=f"allocation_chart.{chart_renderer.format}")
+
+# --- Cache de Análises ---
+# A análise depende só do valor, da Selic, do IPCA e do mês. Valores próximos caem
+# na mesma faixa (escala logarítmica) e, num acerto, os valores em R$ da análise
+# guardada são reescalados para o valor exato do usuário.
+
+# "R$ 250 mil" e afins ficam de fora: são citações (ex.: limite do FGC), não valores da carteira
+BRL_AMOUNT_PATTERN = re.compile(r'(R\$\s*)(\d[\d.,]*\d|\d)(?!\d|\s*(?:mil\b|milh|bilh))')
+ALLOCATED_AMOUNT_LABEL = 'valor alocado'
+
+def parse_brl_amount(raw):
+    # Aceita "1,000.00" (formato do prompt) e "1.000,00" (formato brasileiro);
+    # devolve o valor e o estilo para reescrever no mesmo formato
+    last_sep = max(raw.rfind(','), raw.rfind('.'))
+    decimal_sep = None
+    if last_sep != -1 and 1 <= len(raw) - last_sep - 1 <= 2:
+        decimal_sep = raw[last_sep]
+    if decimal_sep:
+        integer_part, fraction = raw[:last_sep], raw[last_sep + 1:]
+        thousands_sep = ',' if decimal_sep == '.' else '.'
+    else:
+        integer_part, fraction = raw, ''
+        thousands_sep = '.' if '.' in raw else ','
+    value = float(re.sub(r'[.,]', '', integer_part) + ('.' + fraction if fraction else ''))
+    style = 'br' if decimal_sep == ',' or (decimal_sep is None and thousands_sep == '.' and '.' in raw) else 'us'
+    return value, style
+
+def format_brl_amount(value, style):
+    formatted = f"{value:,.2f}"
+    if style == 'br':
+        formatted = formatted.replace(',', '_').replace('.', ',').replace('_', '.')
+    return formatted
+
+def rescale_amounts(text, factor, base=None):
+    # Só muda o que depende do aporte: as linhas "Valor Alocado" e o próprio valor
+    # investido (`base`, no título da carteira). Valores fixos citados pelo modelo
+    # (limite do FGC, preço de uma ação, aplicação mínima) ficam como estão.
+    def rescale_line(line):
+        allocated = ALLOCATED_AMOUNT_LABEL in line.lower()
+
+        def replace(match):
+            value, style = parse_brl_amount(match.group(2))
+            if not allocated and (base is None or not math.isclose(value, base, abs_tol=0.005)):
+                return match.group(0)
+            return match.group(1) + format_brl_amount(value * factor, style)
+        return BRL_AMOUNT_PATTERN.sub(replace, line)
+    return ''.join(rescale_line(line) for line in text.splitlines(keepends=True))
+
+class AnalysisCache:
+    SAVE_LEASE = 'analysis_cache_save'
+    SAVE_LEASE_TTL = 30.0
+
+    def __init__(self, ttl=21600.0, max_entries=200, bucket_width=0.25, path=None, shared=None):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.bucket_width = bucket_width
+        self.path = path or None
+        self.shared = shared  # no modo 'multi', os workers gravam o mesmo arquivo
+        self._entries = OrderedDict()  # chave -> {'text', 'investment_value', 'created_at'}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def value_bucket(self, investment_value):
+        if not math.isfinite(investment_value) or investment_value <= 0:
+            return 0
+        return math.floor(math.log(investment_value) / math.log1p(self.bucket_width))
+
+    def make_key(self, investment_value, selic, ipca, period):
+        return f"{self.value_bucket(investment_value)}|{selic}|{ipca}|{period}"
+
+    def get(self, key, investment_value):
+        entry = self._entries.get(key)
+        if entry is not None and time.time() - entry['created_at'] >= self.ttl:
+            del self._entries[key]
+            entry = None
+        if entry is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        factor = investment_value / entry['investment_value'] if entry['investment_value'] else 1.0
+        return rescale_amounts(entry['text'], factor, base=entry['investment_value']) if factor != 1.0 else entry['text']
+
+    def put(self, key, text, investment_value):
+        self._entries[key] = {'text': text, 'investment_value': investment_value, 'created_at': time.time()}
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def stats(self):
+        return {'entries': len(self._entries), 'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
+
+    def _read(self):
+        if not self.path or not os.path.exists(self.path):
+            return {}
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"Erro ao carregar o cache de análises: {e}")
+            return {}
+
+    def load(self):
+        self.merge(self._read())
+
+    def merge(self, entries):
+        # Deve ser chamado no event loop: adota as entradas gravadas por outros workers
+        now = time.time()
+        for key, entry in sorted(entries.items(), key=lambda item: item[1]['created_at']):
+            current = self._entries.get(key)
+            if now - entry['created_at'] < self.ttl and (current is None or current['created_at'] < entry['created_at']):
+                self._entries[key] = entry
+                self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def snapshot(self):
+        # Deve ser chamado no event loop, que é quem altera o OrderedDict
+        return dict(self._entries)
+
+    def _acquire_save_lease(self):
+        deadline = time.monotonic() + 5.0
+        while True:
+            try:
+                if self.shared.acquire_lease(self.SAVE_LEASE, self.SAVE_LEASE_TTL):
+                    return True
+            except sqlite3.OperationalError:
+                pass
+            if time.monotonic() >= deadline:
+                return False
+            time.sleep(0.05)
+
+    def save(self, snapshot=None):
+        # Roda em thread: grava o retrato tirado no loop e troca o arquivo de forma atômica.
+        # No modo 'multi' o arquivo é relido e mesclado sob um lease do SharedState, para
+        # que um worker não apague as entradas gravadas pelos outros; devolve o resultado
+        # da mescla, que o chamador passa a merge() no loop.
+        if not self.path:
+            return None
+        if snapshot is None:
+            snapshot = self.snapshot()
+        with self._lock:
+            if self.shared is not None and not self._acquire_save_lease():
+                print("Cache de análises não gravado: outro worker está salvando.")
+                return None
+            try:
+                if self.shared is not None:
+                    snapshot = self._merged(self._read(), snapshot)
+                directory = os.path.dirname(self.path)
+                if directory:
+                    os.makedirs(directory, exist_ok=True)
+                fd, tmp_path = tempfile.mkstemp(dir=directory or '.', prefix=os.path.basename(self.path) + '.', suffix='.tmp')
+                try:
+                    with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                        json.dump(snapshot, f, ensure_ascii=False)
+                    os.replace(tmp_path, self.path)
+                except BaseException:
+                    with contextlib.suppress(OSError):
+                        os.remove(tmp_path)
+                    raise
+            except OSError as e:
+                print(f"Erro ao salvar o cache de análises: {e}")
+            finally:
+                if self.shared is not None:
+                    with contextlib.suppress(sqlite3.Error):
+                        self.shared.release_lease(self.SAVE_LEASE)
+        return snapshot
+
+    def _merged(self, on_disk, snapshot):
+        # Fica a entrada mais recente de cada chave, sem as expiradas, até max_entries
+        now = time.time()
+        merged = dict(on_disk)
+        for key, entry in snapshot.items():
+            if key not in merged or merged[key]['created_at'] < entry['created_at']:
+                merged[key] = entry
+        fresh = sorted((item for item in merged.items() if now - item[1]['created_at'] < self.ttl),
+                       key=lambda item: item[1]['created_at'])
+        return dict(fresh[-self.max_entries:])
+
+analysis_cache = AnalysisCache(ttl=ANALYSIS_CACHE_TTL, max_entries=ANALYSIS_CACHE_SIZE,
+                               bucket_width=ANALYSIS_CACHE_BUCKET, path=ANALYSIS_CACHE_PATH, shared=shared_state)
+analysis_cache.load()
+
+# --- Indicadores Técnicos ---
+# Calculados de forma vetorizada sobre todo o histórico salvo (assim as janelas
+# já começam "aquecidas" no trecho exibido) e memorizados por
+# (símbolo, último pregão, indicador, parâmetros).
+
+def simple_moving_average(close, window):
+    return close.rolling(window).mean()
+
+def exponential_moving_average(close, window):
+    return close.ewm(span=window, adjust=False).mean()
+
+def bollinger_bands(close, window=20, num_std=2.0):
+    middle = close.rolling(window).mean()
+    std = close.rolling(window).std()
+    return pd.DataFrame({'middle': middle, 'upper': middle + num_std * std, 'lower': middle - num_std * std})
+
+def relative_strength_index(close, window=14):
+    delta = close.diff()
+    gain = delta.clip(lower=0).ewm(alpha=1 / window, adjust=False, min_periods=window).mean()
+    loss = (-delta.clip(upper=0)).ewm(alpha=1 / window, adjust=False, min_periods=window).mean()
+    rs = gain / loss.replace(0, np.nan)
+    return (100 - 100 / (1 + rs)).where(loss != 0, 100.0)
+
+def rolling_volatility(close, window=21):
+    # Volatilidade anualizada (%) dos retornos logarítmicos diários
+    return np.log(close).diff().rolling(window).std() * np.sqrt(252) * 100
+
+def drawdown(close):
+    return (close / close.cummax() - 1) * 100
+
+INDICATORS = {
+    'mm': simple_moving_average,
+    'mme': exponential_moving_average,
+    'bollinger': bollinger_bands,
+    'rsi': relative_strength_index,
+    'vol': rolling_volatility,
+    'dd': drawdown,
+}
+
+INDICATOR_DEFAULTS = {'mm': (20,), 'mme': (20,), 'bollinger': (20,), 'rsi': (14,), 'vol': (21,), 'dd': ()}
+INDICATOR_ALIASES = {'drawdown': 'dd', 'volatilidade': 'vol', 'bb': 'bollinger'}
+
+def parse_indicator_options(options):
+    # Converte opções como "mm20", "bollinger", "rsi14", "vol" ou "dd" em (nome, parâmetros)
+    parsed = []
+    for option in options:
+        match = re.fullmatch(r'([a-z]+)(\d*)', option.lower())
+        if not match:
+            raise ValueError(option)
+        name, number = match.groups()
+        name = INDICATOR_ALIASES.get(name, name)
+        if name not in INDICATORS or (number and not INDICATOR_DEFAULTS[name]):
+            raise ValueError(option)
+        params = (int(number),) if number else INDICATOR_DEFAULTS[name]
+        if params and not 2 <= params[0] <= 400:
+            raise ValueError(option)
+        if (name, params) not in parsed:
+            parsed.append((name, params))
+    return parsed
+
+class IndicatorMemo:
+    def __init__(self, max_entries=256):
+        self.cache = LRUCache(max_entries)
+
+    @property
+    def hits(self):
+        return self.cache.hits
+
+    @property
+    def misses(self):
+        return self.cache.misses
+
+    def compute(self, symbol, close, name, params):
+        key = (symbol, close.index[-1], len(close), name, params)
+        result = self.cache.get(key)
+        if result is None:
+            result = INDICATORS[name](close, *params)
+            self.cache.put(key, result)
+        return result
+
+indicator_memo = IndicatorMemo(INDICATOR_MEMO_SIZE)
+
+def build_indicator_layers(symbol, close, indicators):
+    overlays, bands, panels = [], [], []
+    for name, params in indicators:
+        result = indicator_memo.compute(symbol, close, name, params)
+        label_params = f"({params[0]})" if params else ""
+        if name == 'mm':
+            overlays.append((f"MM{params[0]}", result))
+        elif name == 'mme':
+            overlays.append((f"MME{params[0]}", result))
+        elif name == 'bollinger':
+            bands.append((f"Bollinger{label_params}", result['lower'], result['upper']))
+            overlays.append((f"Bollinger{label_params} média", result['middle']))
+        elif name == 'rsi':
+            panels.append((f"IFR{label_params}", [(f"IFR{label_params}", result)], (30, 70)))
+        elif name == 'vol':
+            panels.append((f"Vol.{label_params} %", [(f"Volatilidade{label_params}", result)], ()))
+        elif name == 'dd':
+            panels.append(("Drawdown %", [("Drawdown", result)], (0,)))
+    return overlays, bands, panels
+
+async def generate_stock_chart(symbol, history, indicators=()):
+    stock_data = history.tail(STOCK_CHART_LOOKBACK)
+    overlays, bands, panels = build_indicator_layers(symbol, history, indicators)
+    return await generate_line_chart(
+        stock_data,
+        title=f"Preço de Fechamento de {symbol}",
+        cache_key=(symbol, stock_data.index[-1].strftime('%Y-%m-%d'), len(stock_data), tuple(indicators)),
+        overlays=overlays,
+        bands=bands,
+        panels=panels,
+    )
 
-    plt.style.use('dark_background')
-    plt.figure(figsize=(10, 8))
-    plt.pie(sizes, labels=labels, colors=colors, autopct='', startangle=90, wedgeprops={'edgecolor': 'white'})
-    plt.axis('equal')
-    plt.title(title, color='white')
+def normalized_returns(closes):
+    # Alinha as séries nos pregões em comum e rebaseia todas para 100
+    frame = pd.concat(closes, axis=1, join='inner').dropna()
+    if frame.empty:
+        return frame
+    return frame / frame.iloc[0] * 100
+
+# --- Projeção da Carteira (Monte Carlo) ---
+# Cada classe de ativo tem retorno e volatilidade anuais: a renda fixa segue a
+# Selic; as demais usam o histórico local do proxy (quando há pelo menos
+# PROJECTION_MIN_HISTORY pregões) ou as premissas da tabela. Os caminhos são
+# simulados mês a mês, com rebalanceamento, em blocos vetorizados.
+
+PROJECTION_MIN_HISTORY = 756  # ~3 anos de pregões
+PROJECTION_CHUNK_PATHS = 5000
+PROJECTION_PERCENTILES = (5, 25, 50, 75, 95)
+
+ASSET_CLASSES = [
+    # A ordem importa: "Fundos Imobiliários" deve cair em 'fii' antes de 'fundos'
+    {'name': 'renda_fixa', 'label': "Renda fixa", 'keywords': ('renda fixa', 'tesouro', 'cdb', 'lci', 'lca', 'debênture', 'poupança'), 'return': 0.10, 'volatility': 0.01},
+    {'name': 'fii', 'label': "FIIs", 'keywords': ('imobili', 'fii'), 'return': 0.10, 'volatility': 0.15},
+    {'name': 'cripto', 'label': "Criptomoedas", 'keywords': ('cripto', 'bitcoin'), 'return': 0.15, 'volatility': 0.65},
+    {'name': 'fundos', 'label': "Fundos", 'keywords': ('fundo', 'multimercado'), 'return': 0.11, 'volatility': 0.08},
+    {'name': 'acoes', 'label': "Ações", 'keywords': ('ações', 'acoes', 'ação', 'etf', 'bolsa'), 'return': 0.12, 'volatility': 0.22},
+]
+DEFAULT_ASSET_CLASS = 'acoes'
+
+def classify_asset(label):
+    lowered = label.lower()
+    for asset_class in ASSET_CLASSES:
+        if any(keyword in lowered for keyword in asset_class['keywords']):
+            return asset_class['name']
+    return DEFAULT_ASSET_CLASS
+
+def to_rate(value):
+    # Selic/IPCA chegam como texto da API ou como número digitado pelo usuário
+    try:
+        return float(str(value).replace(',', '.')) / 100
+    except (TypeError, ValueError):
+        return None
 
-    buf = io.BytesIO()
-    plt.savefig(buf, format='png', transparent=True)
-    buf.seek(0)
-    plt.close()
-    return discord.File(buf, filename="allocation_chart.png")
+def historical_assumption(close):
+    # Retorno esperado e volatilidade anuais a partir dos log-retornos diários
+    if close is None or len(close) < PROJECTION_MIN_HISTORY:
+        return None
+    log_returns = np.diff(np.log(close.to_numpy(dtype='float64')))
+    drift = log_returns.mean() * 252
+    volatility = log_returns.std() * math.sqrt(252)
+    return math.expm1(drift + volatility ** 2 / 2), volatility
+
+async def asset_class_assumptions(classes, selic):
+    assumptions = {}
+    for asset_class in ASSET_CLASSES:
+        name = asset_class['name']
+        if name not in classes:
+            continue
+        expected, volatility, source = asset_class['return'], asset_class['volatility'], "premissa"
+        if name == 'renda_fixa' and selic is not None:
+            expected, source = selic, "Selic"
+        elif name in PROJECTION_PROXIES:
+            symbol = PROJECTION_PROXIES[name]
+            try:
+                history = await get_price_history(symbol, refresh=False)
+                estimate = historical_assumption(history['close'].dropna() if not history.empty else None)
+            except Exception as e:
+                print(f"Erro ao ler o histórico de {symbol} para a projeção: {e}")
+                estimate = None
+            if estimate is not None:
+                (expected, volatility), source = estimate, symbol
+        assumptions[name] = {'label': asset_class['label'], 'return': expected, 'volatility': volatility, 'source': source}
+    return assumptions
+
+def simulate_portfolio(spec):
+    # Roda no pool (ou em uma thread): recebe apenas dados simples e devolve o
+    # valor relativo de cada caminho mês a mês, começando em 1.
+    rng = np.random.default_rng(spec['seed'])
+    weights = np.asarray(spec['weights'], dtype='float32')
+    drift = np.asarray(spec['drift'], dtype='float32')
+    volatility = np.asarray(spec['volatility'], dtype='float32')
+    shocks = rng.standard_normal((spec['paths'], spec['months'], len(weights)), dtype=np.float32)
+    growth = np.exp(drift + volatility * shocks) @ weights  # carteira rebalanceada todo mês
+    values = np.empty((spec['paths'], spec['months'] + 1), dtype='float32')
+    values[:, 0] = 1.0
+    np.cumprod(growth, axis=1, out=values[:, 1:])
+    return values
+
+class ProjectionEngine:
+    def __init__(self, paths=20000, years=5, budget=3.0, workers=0, chunk_paths=PROJECTION_CHUNK_PATHS, cache_size=64):
+        self.paths = paths
+        self.months = years * 12
+        self.budget = budget
+        self.workers = workers
+        self.chunk_paths = chunk_paths
+        self.seconds_per_path = None  # custo medido na última simulação
+        self._executor = None
+        self._results = LRUCache(cache_size)  # entradas -> resultado
+
+    def _get_executor(self):
+        # Sem workers, os blocos rodam num pool de threads próprio (o NumPy libera o GIL):
+        # uma simulação que estoura o orçamento não ocupa o pool padrão usado por to_thread
+        if self._executor is None:
+            if self.workers > 0:
+                self._executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context('spawn'))
+            else:
+                self._executor = ThreadPoolExecutor(max_workers=min(4, os.cpu_count() or 1), thread_name_prefix='projection')
+        return self._executor
+
+    def _reset_executor(self, executor):
+        if self._executor is executor:
+            self._executor = None
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def plan_paths(self):
+        # Reduz os caminhos se a última simulação indicar que o orçamento estouraria
+        if self.seconds_per_path is None:
+            return self.paths
+        affordable = int(self.budget * 0.5 / self.seconds_per_path)
+        return max(min(self.paths, affordable), min(self.paths, 1000))
+
+    async def simulate(self, weights, drift, volatility, seed):
+        paths = self.plan_paths()
+        seeds = np.random.SeedSequence(seed).spawn(math.ceil(paths / self.chunk_paths))
+        specs = [
+            {'weights': weights, 'drift': drift, 'volatility': volatility, 'months': self.months,
+             'paths': min(self.chunk_paths, paths - index * self.chunk_paths), 'seed': chunk_seed}
+            for index, chunk_seed in enumerate(seeds)
+        ]
+        loop = asyncio.get_running_loop()
+        started_at = time.perf_counter()
+        with metrics.track('projection', 'monte_carlo'):
+            for attempt in range(2):
+                executor = self._get_executor()
+                try:
+                    # A nova tentativa usa o que sobrou do mesmo orçamento
+                    chunks = await asyncio.wait_for(
+                        asyncio.gather(*(loop.run_in_executor(executor, simulate_portfolio, spec) for spec in specs)),
+                        max(0.0, self.budget - (time.perf_counter() - started_at)),
+                    )
+                    break
+                except asyncio.TimeoutError:
+                    # Custo pessimista: a próxima simulação roda no máximo metade dos caminhos
+                    self.seconds_per_path = self.budget / paths
+                    raise
+                except BrokenProcessPool:
+                    # Um worker morreu (ex.: OOM): recria o pool e tenta mais uma vez
+                    print("Pool da projeção quebrado; recriando.")
+                    self._reset_executor(executor)
+                    if attempt:
+                        raise
+        self.seconds_per_path = (time.perf_counter() - started_at) / paths
+        return chunks
+
+    async def project(self, allocations, investment_value, selic, ipca):
+        weights_by_class = {}
+        for label, percentage in allocations.items():
+            asset_class = classify_asset(label)
+            weights_by_class[asset_class] = weights_by_class.get(asset_class, 0) + percentage
+        total = sum(weights_by_class.values())
+        if total <= 0 or not investment_value or investment_value <= 0:
+            return None
+
+        key = (tuple(sorted(weights_by_class.items())), investment_value, selic, ipca, date.today().isoformat())
+        result = self._results.get(key)
+        if result is not None:
+            return result
+
+        assumptions = await asset_class_assumptions(weights_by_class, selic)
+        names = list(assumptions)
+        weights = [weights_by_class[name] / total for name in names]
+        # Retorno anual esperado -> deriva e volatilidade mensais do log-retorno
+        volatility = [assumptions[name]['volatility'] / math.sqrt(12) for name in names]
+        drift = [math.log1p(assumptions[name]['return']) / 12 - vol ** 2 / 2 for name, vol in zip(names, volatility)]
+        # Semente derivada das entradas: a mesma carteira gera a mesma projeção (e o mesmo gráfico em cache)
+        seed = int(hashlib.sha256(repr(key).encode('utf-8')).hexdigest()[:16], 16)
+        chunks = await self.simulate(weights, drift, volatility, seed)
+        # Os percentis sobre todos os caminhos também saem do event loop
+        result = await asyncio.to_thread(self._summarize, chunks, investment_value, ipca)
+        result.update(key=key, assumptions=assumptions)
+        self._results.put(key, result)
+        return result
+
+    def _summarize(self, chunks, investment_value, ipca):
+        values = np.concatenate(chunks)
+        inflation = (1 + (ipca or 0.0)) ** (np.arange(self.months + 1) / 12)
+        nominal = np.percentile(values, PROJECTION_PERCENTILES, axis=0) * investment_value
+        return {
+            'months': self.months,
+            'paths': len(values),
+            'investment_value': investment_value,
+            'percentiles': dict(zip(PROJECTION_PERCENTILES, nominal)),
+            'real_median': nominal[PROJECTION_PERCENTILES.index(50)] / inflation,
+            'loss_probability': float((values[:, -1] < 1.0).mean()),
+            'real_loss_probability': float((values[:, -1] < inflation[-1]).mean()),
+        }
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+projection_engine = ProjectionEngine(paths=PROJECTION_PATHS, years=PROJECTION_YEARS, budget=PROJECTION_BUDGET, workers=PROJECTION_WORKERS)
+
+async def project_allocation(allocations, investment_value, selic, ipca):
+    return await projection_engine.project(allocations, investment_value, to_rate(selic), to_rate(ipca))
+
+async def generate_projection_chart(projection, title="Projeção da Carteira Sugerida"):
+    if projection is None:
+        return None
 
-def is_float(value):
-    try:
-        float(value)
-        return True
-    except ValueError:
-        return False
+    percentiles = projection['percentiles']
+    x = pd.date_range(pd.Timestamp.today().normalize(), periods=projection['months'] + 1, freq=pd.DateOffset(months=1)).to_numpy()
+    spec = {
+        'x': x,
+        'lines': [
+            {'y': percentiles[50], 'label': "Mediana (nominal)", 'color': 'cyan', 'linewidth': 2},
+            {'y': projection['real_median'], 'label': "Mediana (descontada a inflação)", 'color': 'orange'},
+            {'y': np.full(len(x), float(projection['investment_value'])), 'label': "Valor investido", 'color': 'white', 'linewidth': 1},
+        ],
+        'bands': [
+            {'label': "90% dos cenários", 'lower': percentiles[5], 'upper': percentiles[95], 'color': 'deepskyblue'},
+            {'label': "50% dos cenários", 'lower': percentiles[25], 'upper': percentiles[75], 'color': 'cyan'},
+        ],
+        'title': title,
+        'ylabel': "Valor (R$)",
+    }
+    data = await chart_renderer.render(render_line_chart, spec, (projection['key'], projection['paths'], title))
+    return discord.File(io.BytesIO(data), filename=f"projection_chart.{chart_renderer.format}")
+
+def format_projection_summary(projection):
+    years = projection['months'] // 12
+    final = {level: values[-1] for level, values in projection['percentiles'].items()}
+    sources = "; ".join(
+        f"{assumption['label']}: {assumption['return'] * 100:.1f}% a.a., volatilidade {assumption['volatility'] * 100:.0f}% ({assumption['source']})"
+        for assumption in projection['assumptions'].values()
+    )
+    return (
+        f"**Projeção ilustrativa em {years} anos** ({projection['paths']:,} cenários simulados):\n"
+        f"- Mediana: **R$ {final[50]:,.2f}** (R$ {projection['real_median'][-1]:,.2f} em valores de hoje, descontando o IPCA)\n"
+        f"- Metade dos cenários entre R$ {final[25]:,.2f} e R$ {final[75]:,.2f}; 90% entre R$ {final[5]:,.2f} e R$ {final[95]:,.2f}\n"
+        f"- Chance de terminar abaixo do valor investido: {projection['loss_probability'] * 100:.1f}% "
+        f"(abaixo da inflação: {projection['real_loss_probability'] * 100:.1f}%)\n"
+        f"*Premissas: {sources}. Simulação educativa; retornos passados não garantem retornos futuros.*"
+    )
+
+# Limite e pontos de quebra usados para dividir mensagens longas
+MESSAGE_MAX_LEN = 1950  # Margem de segurança para o limite de 2000 caracteres
+MESSAGE_BOUNDARY_PATTERN = re.compile(r'(\n---\n|\n## [^\n]*\n|\n### [^\n]*\n|\n#### [^\n]*\n|\n\n)')
+
+def split_long_message(message_content, max_len=MESSAGE_MAX_LEN):
+    if len(message_content) <= max_len:
+        return [message_content]
+
+    # Tenta dividir por seções de Markdown (cabeçalhos, linhas horizontais) ou quebras de linha duplas
+    # priorizando quebras lógicas
+    parts = MESSAGE_BOUNDARY_PATTERN.split(message_content)
+
+    chunks = []
+    current_part = ""
+    for part in parts:
+        if len(current_part) + len(part) < max_len:
+            current_part += part
+        else:
+            if current_part.strip():
+                chunks.append(current_part.strip())
+            current_part = part
+            # Um único trecho sem quebras lógicas maior que o limite é cortado à força
+            while len(current_part) >= max_len:
+                chunks.append(current_part[:max_len])
+                current_part = current_part[max_len:]
+    if current_part.strip(): # Envia a última parte se houver
+        chunks.append(current_part.strip())
+    return chunks
+
+# --- Entrega de Mensagens ---
+# Fila de saída por canal. Os envios entram na fila sem bloquear quem chama e
+# saem respeitando um balde local por canal (o Discord permite ~5 mensagens a
+# cada 5 s por canal). Enquanto a fila espera, os itens pendentes são agrupados
+# no menor número de mensagens (texto, embeds e anexos juntos) e edições
+# seguidas da mesma mensagem viram uma só.
+
+DISCORD_MESSAGE_LIMIT = 2000
+DISCORD_MAX_EMBEDS = 10
+DISCORD_MAX_FILES = 10
+
+class RateLimitLogHandler(logging.Handler):
+    # O discord.py só informa os 429 pelo log de 'discord.http'
+    def emit(self, record):
+        # Todo 429 gera a linha 'We are being rate limited'; num limite global o
+        # discord.py registra também 'Global rate limit', que não é contada de novo
+        if str(record.msg).startswith('We are being rate limited'):
+            metrics.inc("moneyup_discord_rate_limited_total")
+
+logging.getLogger('discord.http').addHandler(RateLimitLogHandler(level=logging.WARNING))
+
+class OutboxItem:
+    def __init__(self, destination, content=None, embed=None, file=None, standalone=False, message=None):
+        self.destination = destination
+        self.content = content
+        self.embeds = [embed] if embed is not None else []
+        self.files = [file] if file is not None else []
+        self.standalone = standalone
+        self.message = message  # definido para edições
+        self.future = asyncio.get_running_loop().create_future()
+        # Quem não aguarda o envio não deve gerar "exception was never retrieved"
+        self.future.add_done_callback(lambda future: future.cancelled() or future.exception())
+
+class ChannelOutbox:
+    def __init__(self, burst=5, window=5.0, linger=0.1):
+        self.burst = burst
+        self.window = window
+        self.linger = linger
+        self.tokens = float(burst)
+        self.updated_at = time.monotonic()
+        self.items = deque()
+        self.worker = None
+        self.last = None  # future do último item enfileirado
+
+    def take_token(self):
+        # Devolve quanto esperar até haver uma vaga no balde do canal
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.burst / self.window)
+        self.updated_at = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) * self.window / self.burst
+
+    @property
+    def idle(self):
+        return not self.items and (self.worker is None or self.worker.done())
+
+    def next_batch(self):
+        # Junta os primeiros itens da fila em um único envio, se couberem
+        first = self.items.popleft()
+        if first.message is not None:
+            # Edições seguidas da mesma mensagem: só a última precisa ir
+            batch = [first]
+            while self.items and self.items[0].message is first.message:
+                batch.append(self.items.popleft())
+            return batch
+        batch = [first]
+        if first.standalone:
+            return batch
+        content = first.content or ""
+        embeds, files = len(first.embeds), len(first.files)
+        while self.items:
+            item = self.items[0]
+            if item.standalone or item.message is not None:
+                break
+            merged = "\n".join(part for part in (content, item.content) if part)
+            if (len(merged) > DISCORD_MESSAGE_LIMIT or embeds + len(item.embeds) > DISCORD_MAX_EMBEDS
+                    or files + len(item.files) > DISCORD_MAX_FILES):
+                break
+            batch.append(self.items.popleft())
+            content, embeds, files = merged, embeds + len(item.embeds), files + len(item.files)
+        return batch
+
+class MessageOutbox:
+    def __init__(self, burst=5, window=5.0, linger=0.1):
+        self.burst = burst
+        self.window = window
+        self.linger = linger
+        self._channels = {}  # id do canal -> ChannelOutbox
+        self.requested = 0  # envios e edições pedidos
+        self.delivered = 0  # chamadas feitas à API
+        self.rate_waits = 0
+
+    @staticmethod
+    def channel_id(destination):
+        channel = getattr(destination, 'channel', None)
+        return channel.id if channel is not None else destination.id
+
+    def _outbox(self, destination):
+        key = self.channel_id(destination)
+        outbox = self._channels.get(key)
+        if outbox is None:
+            # Descarta filas ociosas cujo balde já teria se recomposto
+            now = time.monotonic()
+            for idle_key in [k for k, o in self._channels.items() if o.idle and now - o.updated_at > self.window]:
+                del self._channels[idle_key]
+            outbox = self._channels[key] = ChannelOutbox(self.burst, self.window, self.linger)
+        return outbox
+
+    def _enqueue(self, item):
+        self.requested += 1
+        outbox = self._outbox(item.destination)
+        outbox.items.append(item)
+        outbox.last = item.future
+        if outbox.worker is None or outbox.worker.done():
+            outbox.worker = asyncio.ensure_future(self._drain(outbox))
+        return item.future
+
+    def send(self, destination, content=None, *, embed=None, file=None, standalone=False):
+        # Devolve um future com a mensagem enviada; aguardá-lo é opcional
+        return self._enqueue(OutboxItem(destination, content, embed=embed, file=file, standalone=standalone))
+
+    def edit(self, destination, message, content):
+        return self._enqueue(OutboxItem(destination, content, message=message))
+
+    async def flush(self, destination):
+        # Aguarda a entrega de tudo o que já foi enfileirado no canal (a ordem é preservada)
+        outbox = self._channels.get(self.channel_id(destination))
+        if outbox is not None and outbox.last is not None:
+            await asyncio.wait([outbox.last])
+
+    async def _drain(self, outbox):
+        if outbox.linger:
+            await asyncio.sleep(outbox.linger)
+        while outbox.items:
+            wait = outbox.take_token()
+            while wait > 0:
+                # Enquanto espera a vaga, novos itens se juntam ao próximo envio
+                self.rate_waits += 1
+                await asyncio.sleep(wait)
+                wait = outbox.take_token()
+            await self._deliver(outbox.next_batch())
+
+    async def _deliver(self, batch):
+        first = batch[0]
+        self.delivered += 1
+        try:
+            if first.message is not None:
+                await first.message.edit(content=batch[-1].content)
+                result = first.message
+            else:
+                kwargs = {}
+                content = "\n".join(item.content for item in batch if item.content)
+                embeds = [embed for item in batch for embed in item.embeds]
+                files = [file for item in batch for file in item.files]
+                if embeds:
+                    kwargs['embeds'] = embeds
+                if files:
+                    kwargs['files'] = files
+                result = await first.destination.send(content or None, **kwargs)
+        except Exception as e:
+            metrics.inc("moneyup_outbox_errors_total")
+            print(f"Erro ao entregar mensagem no canal {self.channel_id(first.destination)}: {e}")
+            for item in batch:
+                if not item.future.done():
+                    item.future.set_exception(e)
+            return
+        for item in batch:
+            if not item.future.done():
+                item.future.set_result(result)
+
+    def stats(self):
+        return {
+            'requested': self.requested,
+            'delivered': self.delivered,
+            'rate_waits': self.rate_waits,
+            'queued': sum(len(outbox.items) for outbox in self._channels.values()),
+        }
+
+message_outbox = MessageOutbox(burst=DISCORD_CHANNEL_BURST, window=DISCORD_CHANNEL_WINDOW, linger=DISCORD_OUTBOX_LINGER)
+
+def deliver(destination, content=None, **kwargs):
+    return message_outbox.send(destination, content, **kwargs)
 
 # Função para dividir mensagens longas (ajustada para 2000 e melhor tratamento de partes)
 async def send_long_message(ctx, message_content):
-    max_len = 1950  # Margem de segurança para o limite de 2000 caracteres
-    if len(message_content) <= max_len:
-        await ctx.send(message_content)
-    else:
-        # Tenta dividir por seções de Markdown (cabeçalhos, linhas horizontais) ou quebras de linha duplas
-        # priorizando quebras lógicas
-        parts = re.split(r'(\n---\n|\n## [^\n]*\n|\n### [^\n]*\n|\n#### [^\n]*\n|\n\n)', message_content)
-        
-        current_part = ""
-        for i, part in enumerate(parts):
-            if len(current_part) + len(part) < max_len:
-                current_part += part
+    # Os trechos entram juntos na fila do canal; a entrega segue em segundo plano
+    for chunk in split_long_message(message_content):
+        deliver(ctx, chunk)
+
+ALLOCATION_PATTERN = re.compile(r"- \*\*(.*?)\*\*:\s*\[(\d+)\]%")
+
+def extract_allocations(text, allocations=None):
+    if allocations is None:
+        allocations = {}
+    for asset_type, percentage_str in ALLOCATION_PATTERN.findall(text):
+        try:
+            percentage = float(percentage_str)
+        except ValueError:
+            continue
+        clean_asset_type = re.sub(r'\s*\(.*?\)', '', asset_type).strip()
+        allocations[clean_asset_type] = percentage
+    return allocations
+
+class StreamingMessageWriter:
+    # Publica no Discord a resposta do modelo conforme ela é gerada. O texto só é
+    # liberado em quebras lógicas (as mesmas de `split_long_message`); enquanto
+    # couber, a última mensagem é editada em vez de criar uma nova.
+    def __init__(self, destination, max_len=MESSAGE_MAX_LEN, on_text=None):
+        self.destination = destination
+        self.max_len = max_len
+        self.on_text = on_text
+        self._buffer = ""
+        self._message = None
+        self._message_content = ""
+        self._pending = []  # pedaços recebidos e ainda não processados
+        self._pump = None
+
+    async def feed(self, text):
+        # Não espera o Discord: a geração (que ocupa uma vaga do Gemini e corre
+        # contra GEMINI_TIMEOUT) segue enquanto uma task publica os pedaços.
+        self._pending.append(text)
+        if self._pump is None or self._pump.done():
+            self._pump = asyncio.ensure_future(self._drain())
+            # Se a geração falhar antes do close(), um erro de envio não fica "não lido"
+            self._pump.add_done_callback(lambda pump: pump.cancelled() or pump.exception())
+
+    async def _drain(self):
+        while self._pending:
+            text = "".join(self._pending)
+            self._pending.clear()
+            await self._consume(text)
+
+    async def _consume(self, text):
+        self._buffer += text
+        boundary_end = None
+        for match in MESSAGE_BOUNDARY_PATTERN.finditer(self._buffer):
+            boundary_end = match.end()
+        if boundary_end is None and len(self._buffer) >= self.max_len:
+            # Sem quebra lógica à vista: libera até a última linha completa
+            last_newline = self._buffer.rfind("\n")
+            boundary_end = last_newline + 1 if last_newline > 0 else len(self._buffer)
+        if boundary_end:
+            ready, self._buffer = self._buffer[:boundary_end], self._buffer[boundary_end:]
+            await self._publish(ready)
+
+    async def close(self):
+        if self._pump is not None:
+            await self._pump
+        await self._drain()
+        if self._buffer:
+            ready, self._buffer = self._buffer, ""
+            await self._publish(ready)
+
+    async def _publish(self, text):
+        if self.on_text:
+            self.on_text(text)
+        combined = self._message_content + text
+        if not combined.strip():
+            return
+        # Envios aguardam a mensagem (para editá-la depois); edições seguem pela fila
+        if len(combined.strip()) <= self.max_len:
+            if self._message is not None:
+                message_outbox.edit(self.destination, self._message, combined.strip())
             else:
-                if current_part.strip():
-                    await ctx.send(current_part.strip())
-                current_part = part
-        if current_part.strip(): # Envia a última parte se houver
-            await ctx.send(current_part.strip())
+                self._message = await message_outbox.send(self.destination, combined.strip(), standalone=True)
+            self._message_content = combined
+            return
+        if not text.strip():
+            return
+        for chunk in split_long_message(text, self.max_len):
+            if chunk.strip():
+                self._message = await message_outbox.send(self.destination, chunk.strip(), standalone=True)
+                self._message_content = chunk
+
+# --- Gatilhos de Conversa Natural ---
+# Tabela declarativa de frases; todas são compiladas em uma única expressão
+# regular com limites de palavra, percorrida uma vez por mensagem.
+
+TRIGGERS = [
+    {
+        'name': 'saudacao',
+        'phrases': ["olá", "oi", "ola"],
+        'response': "Olá, {mention}! Sou o MoneyupInvestiments. Como posso ajudar você hoje com seus investimentos?",
+    },
+    {
+        'name': 'investimento_do_dia',
+        'phrases': ["investimento de hoje", "o que temos para investir"],
+        'response': "Para uma análise completa e sugestões de investimento, por favor, use o comando `!analisar`. Eu farei algumas perguntas para personalizar a análise.",
+    },
+]
+
+class TriggerMatcher:
+    def __init__(self, triggers, channel_cooldown=30.0, user_cooldown=120.0):
+        self.triggers = triggers
+        self.channel_cooldown = channel_cooldown
+        self.user_cooldown = user_cooldown
+        alternatives = []
+        for index, trigger in enumerate(triggers):
+            # Frases mais longas primeiro; espaços casam com qualquer espaçamento
+            phrases = sorted(trigger['phrases'], key=len, reverse=True)
+            escaped = "|".join(r"\s+".join(re.escape(word) for word in phrase.split()) for phrase in phrases)
+            alternatives.append(f"(?P<t{index}>{escaped})")
+        self.pattern = re.compile(r"(?<!\w)(?:" + "|".join(alternatives) + r")(?!\w)", re.IGNORECASE)
+        self._last_reply = {}  # (gatilho, 'c' ou 'u', id) -> momento da última resposta
+        self.scanned = 0
+        self.matched = 0
+        self.suppressed = 0
+
+    def match(self, content):
+        self.scanned += 1
+        found = []
+        for match in self.pattern.finditer(content):
+            index = int(match.lastgroup[1:])
+            if index not in found:
+                found.append(index)
+                if len(found) == len(self.triggers):
+                    break
+        if found:
+            self.matched += 1
+        return sorted(found)
+
+    def _on_cooldown(self, index, channel_id, user_id, now):
+        channel_key, user_key = (index, 'c', channel_id), (index, 'u', user_id)
+        if now - self._last_reply.get(channel_key, -math.inf) < self.channel_cooldown:
+            return True
+        if now - self._last_reply.get(user_key, -math.inf) < self.user_cooldown:
+            return True
+        self._last_reply[channel_key] = now
+        self._last_reply[user_key] = now
+        if len(self._last_reply) > 10000:
+            horizon = now - max(self.channel_cooldown, self.user_cooldown)
+            self._last_reply = {key: moment for key, moment in self._last_reply.items() if moment >= horizon}
+        return False
+
+    def replies(self, message):
+        now = time.monotonic()
+        responses = []
+        for index in self.match(message.content):
+            if self._on_cooldown(index, message.channel.id, message.author.id, now):
+                self.suppressed += 1
+                continue
+            responses.append(self.triggers[index]['response'].format(mention=message.author.mention))
+        return responses
+
+    def stats(self):
+        return {'scanned': self.scanned, 'matched': self.matched, 'suppressed': self.suppressed}
+
+trigger_matcher = TriggerMatcher(TRIGGERS, channel_cooldown=TRIGGER_CHANNEL_COOLDOWN, user_cooldown=TRIGGER_USER_COOLDOWN)
+
+# --- Tarefas em Segundo Plano ---
+# Mantêm os caches aquecidos para que os comandos dos usuários não paguem o custo
+# da primeira chamada (BCB, Alpha Vantage, Gemini e matplotlib).
+
+class BackgroundScheduler:
+    def __init__(self):
+        self._jobs = []
+        self._tasks = []
+        self.stats = {}  # nome -> {'runs', 'failures', 'last_duration'}
+
+    def add(self, name, func, interval=None, initial_delay=0.0):
+        # interval=None executa a tarefa uma única vez
+        self._jobs.append((name, func, interval, initial_delay))
+
+    @property
+    def started(self):
+        return bool(self._tasks)
+
+    def start(self):
+        if self.started:
+            return
+        for job in self._jobs:
+            self._tasks.append(asyncio.ensure_future(self._run_job(*job)))
+
+    def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
+
+    async def _run_job(self, name, func, interval, initial_delay):
+        await asyncio.sleep(initial_delay)
+        stats = self.stats.setdefault(name, {'runs': 0, 'failures': 0, 'last_duration': None})
+        while True:
+            started_at = time.perf_counter()
+            try:
+                await func()
+            except Exception as e:
+                stats['failures'] += 1
+                print(f"Erro na tarefa em segundo plano '{name}': {e}")
+            stats['runs'] += 1
+            stats['last_duration'] = time.perf_counter() - started_at
+            if interval is None:
+                return
+            await asyncio.sleep(interval)
+
+async def refresh_indicators():
+    await asyncio.gather(*(indicator_cache.refresh(key, fetcher) for key, fetcher in INDICATOR_FETCHERS.items()))
+
+async def prefetch_watchlist():
+    for symbol in PREFETCH_SYMBOLS:
+        # Não consome a parte do orçamento diário reservada aos usuários
+        if alpha_vantage_scheduler.remaining_today() <= PREFETCH_RESERVE:
+            print("Pré-busca interrompida: orçamento diário da Alpha Vantage reservado aos usuários.")
+            return
+        history = await get_stock_data(symbol, lookback=None, priority=AlphaVantageScheduler.PRIORITY_BACKGROUND)
+        if history is not None and not history.empty:
+            # Deixa o gráfico padrão de `!grafico_acao` já renderizado no cache
+            await generate_stock_chart(symbol, history)
+
+async def warm_up_imports():
+    # Carrega fora do event loop os módulos adiados na inicialização
+    await asyncio.to_thread(load_lazy_modules)
+    startup_report("aquecimento concluído")
+
+async def warm_up_generation():
+    # A primeira chamada cria o cliente gRPC do Gemini; contar tokens não gera custo
+    model = await asyncio.to_thread(lambda: generation_engine.model)
+    await model.count_tokens_async("MoneyupInvestiments")
+
+async def precompute_market_perception():
+    get_market_perception(datetime.now().month)
+
+background_scheduler = BackgroundScheduler()
+background_scheduler.add('importacoes', warm_up_imports)
+background_scheduler.add('indicadores', refresh_indicators, interval=INDICATOR_REFRESH_INTERVAL)
+background_scheduler.add('percepcao_mercado', precompute_market_perception, interval=3600)
+background_scheduler.add('graficos', chart_renderer.warm_up)
+background_scheduler.add('gemini', warm_up_generation)
+background_scheduler.add('series_macro', macro_engine.refresh_all, interval=MACRO_REFRESH_INTERVAL, initial_delay=10.0)
+if PREFETCH_SYMBOLS:
+    background_scheduler.add('watchlist', prefetch_watchlist, interval=PREFETCH_INTERVAL, initial_delay=5.0)
 
 # --- Eventos do Bot Discord ---
 
@@ -149,29 +2938,35 @@ async def send_long_message(ctx, message_content):
 async def on_ready():
     print(f'{bot.user.name} está online!')
     print('---')
+    startup_report("conectado")
+    background_scheduler.start()
+    if not getattr(bot, 'sessions_resumed', False):
+        bot.sessions_resumed = True
+        await resume_sessions()
 
 @bot.event
 async def on_command_error(ctx, error):
     if isinstance(error, commands.CommandNotFound):
         await ctx.send("Comando não encontrado. Use `!ajuda` para ver os comandos disponíveis.")
     else:
+        if ctx.command is not None:
+            metrics.inc("moneyup_command_errors_total", name=ctx.command.qualified_name)
         print(f"Erro no comando: {error}")
         await ctx.send(f"Ocorreu um erro ao executar o comando: `{error}`")
 
 @bot.event
 async def on_message(message):
-    if message.author == bot.user:
+    # Mensagens de bots (inclusive as nossas) são descartadas antes de qualquer processamento
+    if message.author.bot:
         return
 
-    msg_content = message.content.lower()
-
-    if "olá" in msg_content or "oi" in msg_content or "ola" in msg_content:
-        if not msg_content.startswith(bot.command_prefix):
-            await message.channel.send(f"Olá, {message.author.mention}! Sou o MoneyupInvestiments. Como posso ajudar você hoje com seus investimentos?")
+    # Respostas a uma análise em andamento vão direto para a sessão correspondente
+    if conversation_engine.dispatch(message):
+        return
 
-    if "investimento de hoje" in msg_content or "o que temos para investir" in msg_content:
-        if not msg_content.startswith(bot.command_prefix):
-            await message.channel.send(f"Para uma análise completa e sugestões de investimento, por favor, use o comando `!analisar`. Eu farei algumas perguntas para personalizar a análise.")
+    if not message.content.startswith(bot.command_prefix):
+        for response in trigger_matcher.replies(message):
+            await message.channel.send(response)
 
     await bot.process_commands(message)
 
@@ -186,7 +2981,9 @@ async def help_command(ctx):
     )
     embed.add_field(name="`!analisar`", value="Peça uma análise de mercado e sugestões de investimento específicas.", inline=False)
     embed.add_field(name="`!conceito [termo]`", value="Obtenha uma explicação detalhada sobre Tesouro Direto, CDB, LCI, LCA, Ações, Fundos de Investimento ou Criptomoedas.", inline=False)
-    embed.add_field(name="`!grafico_acao [simbolo]`", value="Gera um gráfico histórico de preço para um símbolo de ação (ex: `!grafico_acao IBM`).", inline=False)
+    embed.add_field(name="`!grafico_acao [simbolo] [indicadores]`", value="Gera um gráfico histórico de preço para um símbolo de ação (ex: `!grafico_acao IBM`). Indicadores opcionais: `mm20`, `mme50`, `bollinger`, `rsi`, `vol`, `dd` (ex: `!grafico_acao IBM mm20 mm50 rsi`).", inline=False)
+    embed.add_field(name="`!comparar [simbolos]`", value="Compara o retorno normalizado de vários símbolos em um gráfico (ex: `!comparar IBM MSFT GOOGL`).", inline=False)
+    embed.add_field(name="`!historico [serie] [periodo]`", value="Mostra o histórico de uma série do Banco Central: `selic`, `ipca`, `cdi` ou `juro_real` (Selic descontada a inflação). Período em anos, meses ou dias, ou `max` (ex: `!historico selic 5a`, `!historico juro_real 10a`).", inline=False)
     embed.add_field(name="`!limpar_dados`", value="Limpa os dados da sua sessão atual (útil se quiser recomeçar uma análise).", inline=False)
     embed.add_field(name="`!ajuda`", value="Mostra esta mensagem de ajuda.", inline=False)
     embed.add_field(name="Interações Naturais (sem `!`):", value="Você também pode tentar dizer:\n- `Olá` ou `Oi`\n- `Qual o investimento de hoje`\n- `O que temos para investir`\nPara uma conversa inicial e dicas.", inline=False)
@@ -195,13 +2992,108 @@ async def help_command(ctx):
 
 @bot.command(name='limpar_dados', help='Limpa os dados da sua sessão atual.')
 async def clear_data(ctx):
-    user_id = ctx.author.id
-    if user_id in user_session_data:
-        del user_session_data[user_id]
+    sessions = await user_session_data.by_author(ctx.author.id)
+    for session in sessions:
+        analysis_tasks.pop(session.key, None)
+        conversation_engine.cancel(session.key)
+        generation_engine.cancel(session.key)
+        await user_session_data.delete(session.key)
+    if sessions:
         await ctx.send("Seus dados de sessão foram limpos. Você pode iniciar uma nova análise com `!analisar`.")
     else:
         await ctx.send("Não há dados de sessão para limpar.")
 
+@bot.command(name='shards', help='Mostra a saúde e a latência de cada shard do bot.')
+async def shards_status(ctx):
+    lines = []
+    if shared_state is not None:
+        now = time.time()
+        for shard_id, pid, latency, guilds, updated_at in await asyncio.to_thread(shared_state.shard_report):
+            status = "ok" if now - updated_at < 3 * SHARD_HEALTH_INTERVAL else "sem sinal"
+            latency_text = f"{latency * 1000:.0f} ms" if latency is not None else "-"
+            lines.append(f"Shard {shard_id} (pid {pid}): {latency_text}, {guilds} servidor(es), {status}")
+    else:
+        counts = shard_guild_counts()
+        for shard_id, latency in bot.shard_latencies():
+            latency_text = f"{latency * 1000:.0f} ms" if math.isfinite(latency) else "-"
+            lines.append(f"Shard {shard_id}: {latency_text}, {counts.get(shard_id, 0)} servidor(es)")
+    current_shard = ctx.guild.shard_id if ctx.guild else 0
+    await ctx.send(f"**Shards** (este canal está no shard {current_shard}):\n" + "\n".join(lines))
+
+@bot.before_invoke
+async def before_command(ctx):
+    ctx.command_started_at = time.perf_counter()
+    metrics.add_gauge("moneyup_command_in_flight", 1, name=ctx.command.qualified_name)
+
+@bot.after_invoke
+async def after_command(ctx):
+    # Inclui o tempo que o usuário leva para responder nos comandos interativos
+    metrics.add_gauge("moneyup_command_in_flight", -1, name=ctx.command.qualified_name)
+    metrics.observe("moneyup_command_seconds", time.perf_counter() - ctx.command_started_at, name=ctx.command.qualified_name)
+
+def collect_component_metrics():
+    values = {}
+    def put(metric, value, **labels):
+        values[Metrics._key(metric, labels)] = value
+    put("moneyup_generation_in_flight", generation_engine.in_flight)
+    put("moneyup_generation_queued", generation_engine.queued)
+    put("moneyup_conversations_waiting", conversation_engine.waiting)
+    put("moneyup_analysis_tasks", len(analysis_tasks))
+    for key, value in message_outbox.stats().items():
+        put("moneyup_outbox", value, stat=key)
+    for key, value in alpha_vantage_scheduler.stats().items():
+        put("moneyup_alpha_vantage", value, stat=key)
+    for key, value in analysis_cache.stats().items():
+        put("moneyup_analysis_cache", value, stat=key)
+    for key, value in trigger_matcher.stats().items():
+        put("moneyup_triggers", value, stat=key)
+    put("moneyup_cache_hits", indicator_cache.hits, cache='indicators')
+    put("moneyup_cache_misses", indicator_cache.misses, cache='indicators')
+    put("moneyup_cache_hits", chart_renderer.cache.hits, cache='charts')
+    put("moneyup_cache_misses", chart_renderer.cache.misses, cache='charts')
+    put("moneyup_cache_hits", indicator_memo.hits, cache='technical_indicators')
+    put("moneyup_cache_misses", indicator_memo.misses, cache='technical_indicators')
+    for shard_id, latency in bot.shard_latencies():
+        put("moneyup_gateway_latency_seconds", latency if math.isfinite(latency) else None, shard=shard_id)
+    put("moneyup_rss_megabytes", current_rss_mb())
+    return values
+
+metrics.collectors.append(collect_component_metrics)
+
+def format_latency(histogram):
+    if histogram is None or not histogram.count:
+        return "sem dados"
+    p50, p99 = histogram.quantile(0.5), histogram.quantile(0.99)
+    return f"{histogram.count}x, p50 ≤ {p50 * 1000:.0f} ms, p99 ≤ {p99 * 1000:.0f} ms"
+
+@bot.command(name='status', help='Mostra métricas de desempenho do bot (apenas administradores).')
+@commands.check_any(commands.is_owner(), commands.has_permissions(administrator=True))
+async def status_command(ctx):
+    embed = discord.Embed(title="Status do MoneyupInvestiments", color=discord.Color.blue())
+    uptime = timedelta(seconds=int(time.time() - metrics.started_at))
+    embed.add_field(name="Processo", value=f"Ativo há {uptime}, RSS {current_rss_mb():.0f} MB\nAtraso do event loop: {format_latency(metrics.histogram('moneyup_event_loop_lag_seconds'))}", inline=False)
+    for title, metric in (("Comandos", "moneyup_command_seconds"), ("Dependências", "moneyup_dependency_seconds"),
+                          ("Gráficos", "moneyup_chart_seconds"), ("Discord", "moneyup_discord_seconds")):
+        histograms = metrics.histograms_named(metric)
+        if histograms:
+            lines = []
+            for name, histogram in sorted(histograms.items(), key=lambda item: -item[1].count)[:8]:
+                errors = metrics.counters.get(Metrics._key(metric.replace('_seconds', '_errors_total'), {'name': name}), 0)
+                lines.append(f"`{name}`: {format_latency(histogram)}" + (f", {errors} erro(s)" if errors else ""))
+            embed.add_field(name=title, value="\n".join(lines)[:1024], inline=False)
+    quota = alpha_vantage_scheduler.stats()
+    cache = analysis_cache.stats()
+    outbox = message_outbox.stats()
+    embed.add_field(name="Filas e caches", value=(
+        f"Gemini: {generation_engine.in_flight} em andamento, {generation_engine.queued} na fila\n"
+        f"Alpha Vantage: {quota['remaining_minute']} restantes no minuto, {quota['remaining_today']} hoje, {quota['queued']} na fila\n"
+        f"Análises em cache: {cache['entries']} ({cache['hits']} acertos, {cache['misses']} falhas)\n"
+        f"Gráficos em cache: {len(chart_renderer.cache)} ({chart_renderer.cache.hits} acertos)\n"
+        f"Mensagens: {outbox['requested']} pedidas, {outbox['delivered']} chamadas à API, {outbox['queued']} na fila, "
+        f"{sum(value for (name, _), value in metrics.counters.items() if name == 'moneyup_discord_rate_limited_total')} respostas 429"
+    ), inline=False)
+    await ctx.send(embed=embed)
+
 @bot.command(name='conceito', help='Explica um tipo de investimento (ex: !conceito Ações).')
 async def concept(ctx, *, investment_type: str):
     investment_type = investment_type.lower().strip()
@@ -234,113 +3126,167 @@ async def concept(ctx, *, investment_type: str):
     else:
         await ctx.send(f"Desculpe, não encontrei informações sobre '{investment_type}'. Tente um dos seguintes: Tesouro Direto, CDB, LCI, LCA, Ações, Fundos de Investimento ou Criptomoedas.")
 
-@bot.command(name='grafico_acao', help='Gera um gráfico histórico de preço para um símbolo de ação (ex: !grafico_acao IBM).')
-async def stock_chart(ctx, symbol: str):
+@bot.command(name='grafico_acao', help='Gera um gráfico histórico de preço para um símbolo de ação (ex: !grafico_acao IBM mm20 bollinger rsi).')
+async def stock_chart(ctx, symbol: str, *options: str):
+    try:
+        indicators = parse_indicator_options(options)
+    except ValueError as e:
+        await ctx.send(f"Opção desconhecida: `{e}`. Use `mm20`, `mme50`, `bollinger`, `rsi`, `vol` ou `dd` (ex: `!grafico_acao IBM mm20 mm50 rsi`).")
+        return
+
     await ctx.send(f"Buscando dados históricos para **{symbol.upper()}**... Isso pode levar um momento.")
-    stock_data = await get_stock_data(symbol.upper())
+
+    async def notify_queue_position(position, wait_seconds):
+        await ctx.send(f"Limite de requisições da Alpha Vantage em uso: você é o **{position}º** na fila (espera estimada de ~{wait_seconds:.0f}s).")
+
+    history = await get_stock_data(symbol.upper(), lookback=None, on_queued=notify_queue_position)
+    stock_data = history.tail(STOCK_CHART_LOOKBACK) if history is not None else None
 
     if stock_data is not None and not stock_data.empty:
-        chart_file = await generate_line_chart(stock_data, title=f"Preço de Fechamento de {symbol.upper()}")
+        chart_file = await generate_stock_chart(symbol.upper(), history, indicators)
         if chart_file:
             await ctx.send(file=chart_file)
         else:
             await ctx.send(f"Não foi possível gerar o gráfico para {symbol.upper()}.")
+    elif alpha_vantage_scheduler.remaining_today() <= 0:
+        await ctx.send(f"O limite diário de {alpha_vantage_scheduler.per_day} requisições da Alpha Vantage foi atingido. Tente novamente amanhã.")
     else:
         await ctx.send(f"Não foi possível obter dados para o símbolo **{symbol.upper()}**. Verifique se o símbolo está correto (ex: `IBM` para ações americanas, ou pode ser necessário adicionar `.SA` para brasileiras, como `PETR4.SA` se sua chave da Alpha Vantage suportar) ou se há um problema com a API.")
-        await ctx.send("Lembre-se que a API gratuita da Alpha Vantage tem limites de requisição (5 requisições por minuto, 500 por dia) e pode focar mais em mercados globais (EUA).")
+        quota = alpha_vantage_scheduler.stats()
+        await ctx.send(f"Lembre-se que a API gratuita da Alpha Vantage tem limites de requisição ({alpha_vantage_scheduler.per_minute} requisições por minuto, {alpha_vantage_scheduler.per_day} por dia) e pode focar mais em mercados globais (EUA). Restam {quota['remaining_minute']} neste minuto e {quota['remaining_today']} hoje.")
+
+@bot.command(name='comparar', help='Compara o retorno de vários símbolos em um único gráfico (ex: !comparar IBM MSFT GOOGL).')
+async def compare_stocks(ctx, *symbols: str):
+    symbols = list(dict.fromkeys(symbol.upper() for symbol in symbols))
+    if len(symbols) < 2:
+        await ctx.send("Informe pelo menos dois símbolos (ex: `!comparar IBM MSFT GOOGL`).")
+        return
+    if len(symbols) > COMPARE_MAX_SYMBOLS:
+        await ctx.send(f"Compare no máximo {COMPARE_MAX_SYMBOLS} símbolos por vez.")
+        return
 
-@bot.command(name='analisar', help='Inicia uma análise de mercado e sugestões de investimento.')
-async def analyze_investment(ctx):
-    user_id = ctx.author.id
-    user_session_data[user_id] = {}
+    await ctx.send(f"Buscando dados históricos para **{', '.join(symbols)}**... Isso pode levar um momento.")
 
-    await ctx.send("Olá! Sou o MoneyupInvestiments. Vamos iniciar sua análise de investimento para este mês.")
+    async def notify_queue_position(position, wait_seconds):
+        await ctx.send(f"Limite de requisições da Alpha Vantage em uso: posição **{position}º** na fila (espera estimada de ~{wait_seconds:.0f}s).")
 
-    await ctx.send("Primeiro, qual o **valor total que você pretende investir este mês** (apenas o número, ex: `1000`)?")
-    try:
-        investment_value_msg = await bot.wait_for('message', check=lambda m: m.author == ctx.author and m.channel == ctx.channel and is_float(m.content), timeout=60.0)
-        user_session_data[user_id]['investment_value'] = float(investment_value_msg.content)
-        await ctx.send(f"Ok, você pretende investir R$ {user_session_data[user_id]['investment_value']:,.2f}.")
-    except asyncio.TimeoutError:
-        await ctx.send("Tempo esgotado. Por favor, tente `!analisar` novamente.")
-        if user_id in user_session_data: del user_session_data[user_id]
+    # Todos os símbolos entram juntos na fila da Alpha Vantage
+    results = await asyncio.gather(*(get_stock_data(symbol, on_queued=notify_queue_position) for symbol in symbols))
+    missing = [symbol for symbol, data in zip(symbols, results) if data is None or data.empty]
+    closes = [data.rename(symbol) for symbol, data in zip(symbols, results) if data is not None and not data.empty]
+    if missing:
+        await ctx.send(f"Não foi possível obter dados para: **{', '.join(missing)}**.")
+    if len(closes) < 2:
         return
+
+    normalized = normalized_returns(closes)
+    if normalized.empty:
+        await ctx.send("Os símbolos informados não têm pregões em comum para comparar.")
+        return
+    cache_key = tuple((close.name, close.index[-1].strftime('%Y-%m-%d'), len(close)) for close in closes)
+    chart_file = await generate_comparison_chart(normalized, title=f"Retorno Normalizado: {' x '.join(normalized.columns)}", cache_key=cache_key)
+    if chart_file:
+        await ctx.send(file=chart_file)
+    else:
+        await ctx.send("Não foi possível gerar o gráfico de comparação.")
+
+REAL_RATE_ALIASES = ('juro_real', 'juros_reais', 'juro', 'real')
+HISTORY_USAGE = "Use `!historico [serie] [periodo]`, com a série {series} ou `juro_real` e o período em anos, meses ou dias (ex: `!historico selic 5a`, `!historico ipca 18m`, `!historico juro_real max`)."
+
+def describe_series(series, unit):
+    return (f"Atual: **{series.iloc[-1]:.2f}{unit}** ({series.index[-1].strftime('%d/%m/%Y')}) · "
+            f"mínima {series.min():.2f}{unit} · máxima {series.max():.2f}{unit} · média {series.mean():.2f}{unit}")
+
+@bot.command(name='historico', help='Mostra o histórico de uma série do Banco Central (ex: !historico selic 5a, !historico juro_real 10a).')
+async def macro_history(ctx, name: str = 'selic', period: str = '5a'):
+    name = name.lower()
+    usage = HISTORY_USAGE.format(series=", ".join(f"`{series}`" for series in MACRO_SERIES))
+    try:
+        since = parse_period(period)
     except ValueError:
-        await ctx.send("Valor inválido. Por favor, insira um número válido. Tente `!analisar` novamente.")
-        if user_id in user_session_data: del user_session_data[user_id]
+        await ctx.send(f"Período inválido: `{period}`. {usage}")
         return
 
-    current_selic = await get_selic_rate()
-    if not current_selic:
-        await ctx.send("Não consegui buscar a **taxa Selic** atual automaticamente. Poderia me informar qual a taxa Selic desse mês (ex: `10.75`)?")
-        try:
-            selic_msg = await bot.wait_for('message', check=lambda m: m.author == ctx.author and m.channel == ctx.channel and is_float(m.content), timeout=60.0)
-            user_session_data[user_id]['selic'] = float(selic_msg.content)
-            await ctx.send(f"Entendido! Usarei a Selic de **{user_session_data[user_id]['selic']}%**.")
-        except asyncio.TimeoutError:
-            await ctx.send("Tempo esgotado para informar a Selic. A análise será menos precisa sem essa informação.")
-            user_session_data[user_id]['selic'] = None
-        except ValueError:
-            await ctx.send("Valor inválido para a Selic. Análise sem essa informação.")
-            user_session_data[user_id]['selic'] = None
+    if name in REAL_RATE_ALIASES:
+        if 'selic' not in MACRO_SERIES or 'ipca' not in MACRO_SERIES:
+            await ctx.send("As séries `selic` e `ipca` precisam estar configuradas para calcular o juro real.")
+            return
+        # Um mês a mais para o primeiro ponto mensal cobrir o início do período
+        start = (pd.Timestamp(since) - pd.DateOffset(months=1)).date() if since else None
+        selic, ipca = await asyncio.gather(macro_engine.get('selic', start), macro_engine.get('ipca', start))
+        if selic is None or ipca is None or selic.empty or ipca.empty:
+            await ctx.send("Não foi possível obter o histórico da Selic e do IPCA no Banco Central. Tente novamente mais tarde.")
+            return
+        real = real_interest_rate(selic, ipca)
+        if since:
+            real = real[real.index >= pd.Timestamp(since).replace(day=1)]
+        if real.empty:
+            await ctx.send("Não há meses com Selic e IPCA em comum nesse período.")
+            return
+        title = f"Juro Real (Selic descontada do IPCA 12 meses) — {period}"
+        chart_file = await generate_line_chart(
+            real, title=title, ylabel="% a.a.",
+            cache_key=('juro_real', str(real.index[0]), str(real.index[-1]), len(real), float(real.iloc[-1])),
+            overlays=[("Selic", monthly(selic)), ("IPCA 12 meses", monthly(ipca))],
+        )
+        summary = describe_series(real, "% a.a.")
+    elif name in MACRO_SERIES:
+        series = await macro_engine.get(name, since)
+        if series is None or series.empty:
+            await ctx.send(f"Não foi possível obter o histórico de **{name}** no Banco Central. Tente novamente mais tarde.")
+            return
+        label = MACRO_SERIES_LABELS.get(name, name.upper())
+        unit = "%" if name == 'ipca' else "% a.a."
+        title = f"{label} — {period}"
+        chart_file = await generate_line_chart(
+            series, title=title, ylabel=unit,
+            cache_key=(name, str(series.index[0]), str(series.index[-1]), len(series), float(series.iloc[-1])),
+        )
+        summary = describe_series(series, unit)
     else:
-        user_session_data[user_id]['selic'] = current_selic
-        await ctx.send(f"A taxa Selic atual (via API) é: **{user_session_data[user_id]['selic']}%**.")
+        await ctx.send(f"Série desconhecida: `{name}`. {usage}")
+        return
 
-    current_ipca = await get_ipca_rate()
-    if not current_ipca:
-        await ctx.send("Não consegui buscar a **taxa IPCA (inflação)** atual automaticamente. Poderia me informar qual a taxa IPCA desse mês (ex: `0.5`)?")
-        try:
-            ipca_msg = await bot.wait_for('message', check=lambda m: m.author == ctx.author and m.channel == ctx.channel and is_float(m.content), timeout=60.0)
-            user_session_data[user_id]['ipca'] = float(ipca_msg.content)
-            await ctx.send(f"Ok! Usarei o IPCA de **{user_session_data[user_id]['ipca']}%**.")
-        except asyncio.TimeoutError:
-            await ctx.send("Tempo esgotado para informar o IPCA. Análise sem essa informação.")
-            user_session_data[user_id]['ipca'] = None
-        except ValueError:
-            await ctx.send("Valor inválido para o IPCA. Análise sem essa informação.")
-            user_session_data[user_id]['ipca'] = None
+    await ctx.send(f"**{title}**\n{summary}")
+    if chart_file:
+        await ctx.send(file=chart_file)
     else:
-        user_session_data[user_id]['ipca'] = current_ipca
-        await ctx.send(f"A taxa IPCA atual (via API) é: **{user_session_data[user_id]['ipca']}%**.")
-         # --- NOVA LÓGICA: Gerar percepção de mercado automaticamente ---
-    current_month = datetime.now().month
-    market_perception_generated = ""
+        await ctx.send("Não foi possível gerar o gráfico do histórico.")
+
+@functools.lru_cache(maxsize=12)
+def get_market_perception(current_month):
     if current_month == 1: # Janeiro
-        market_perception_generated = "Mercado de ações global iniciando o ano com cautela, mas com expectativas de recuperação no segundo semestre."
+        return "Mercado de ações global iniciando o ano com cautela, mas com expectativas de recuperação no segundo semestre."
     elif current_month == 2: # Fevereiro
-        market_perception_generated = "Fevereiro pode trazer volatilidade com balanços de empresas e discussões sobre inflação."
+        return "Fevereiro pode trazer volatilidade com balanços de empresas e discussões sobre inflação."
     elif current_month == 3: # Março
-        market_perception_generated = "Março, geralmente um mês de transição, com investidores avaliando dados econômicos do trimestre."
+        return "Março, geralmente um mês de transição, com investidores avaliando dados econômicos do trimestre."
     elif current_month == 4: # Abril
-        market_perception_generated = "Abril pode ser favorável, historicamente um bom mês para ações, mas com atenção a indicadores de inflação."
+        return "Abril pode ser favorável, historicamente um bom mês para ações, mas com atenção a indicadores de inflação."
     elif current_month == 5: # Maio
-        market_perception_generated = "Maio, tradicionalmente mais calmo ("'sell in May and go away'"), mas oportunidades podem surgir em setores específicos."
+        return "Maio, tradicionalmente mais calmo ("'sell in May and go away'"), mas oportunidades podem surgir em setores específicos."
     elif current_month == 6: # Junho
-        market_perception_generated = "Junho, marcado por decisões de juros de bancos centrais e fim do segundo trimestre, pode ter maior volatilidade."
+        return "Junho, marcado por decisões de juros de bancos centrais e fim do segundo trimestre, pode ter maior volatilidade."
     elif current_month == 7: # Julho
-        market_perception_generated = "Julho, início do segundo semestre, com mercado buscando direções em meio a novas políticas econômicas."
+        return "Julho, início do segundo semestre, com mercado buscando direções em meio a novas políticas econômicas."
     elif current_month == 8: # Agosto
-        market_perception_generated = "Agosto, atenção a dados de emprego e inflação, com possível desaceleração em alguns setores."
+        return "Agosto, atenção a dados de emprego e inflação, com possível desaceleração em alguns setores."
     elif current_month == 9: # Setembro
-        market_perception_generated = "Setembro é historicamente um mês de maior correção, com cautela predominante no mercado."
+        return "Setembro é historicamente um mês de maior correção, com cautela predominante no mercado."
     elif current_month == 10: # Outubro
-        market_perception_generated = "Outubro, com expectativas de recuperação para o final do ano, mas ainda com incertezas globais."
+        return "Outubro, com expectativas de recuperação para o final do ano, mas ainda com incertezas globais."
     elif current_month == 11: # Novembro
-        market_perception_generated = "Novembro, focado em resultados de Black Friday e projeções para o consumo de fim de ano, com um viés mais otimista."
+        return "Novembro, focado em resultados de Black Friday e projeções para o consumo de fim de ano, com um viés mais otimista."
     elif current_month == 12: # Dezembro
-        market_perception_generated = "Dezembro, o ''rally'' de fim de ano pode trazer ganhos, mas a liquidez reduzida exige cautela."
+        return "Dezembro, o ''rally'' de fim de ano pode trazer ganhos, mas a liquidez reduzida exige cautela."
     else:
-        market_perception_generated = "Análise de mercado geral: o cenário atual exige atenção a dados de inflação e movimentos de bancos centrais."
-
-    user_session_data[user_id]['market_perception'] = market_perception_generated
-    await ctx.send(f"Minha análise do mercado para este mês ({datetime.now().strftime('%B')}): '{user_session_data[user_id]['market_perception']}'.")
-    # --- FIM DA NOVA LÓGICA ---
+        return "Análise de mercado geral: o cenário atual exige atenção a dados de inflação e movimentos de bancos centrais."
 
-    investment_value = user_session_data[user_id]['investment_value']
-    selic_info = f"Taxa Selic: {user_session_data[user_id]['selic']}%" if user_session_data[user_id]['selic'] else "Taxa Selic não informada. Assuma um valor médio para um perfil moderado (ex: entre 10-12% ao ano)."
-    ipca_info = f"Taxa IPCA: {user_session_data[user_id]['ipca']}%" if user_session_data[user_id]['ipca'] else "Taxa IPCA não informada. Assuma um valor médio da inflação recente."
-    market_perception_info = f"Percepção do mercado de ações (gerada automaticamente): {user_session_data[user_id]['market_perception']}" # Ajustado aqui
+def build_analysis_prompt(session):
+    investment_value = session.investment_value
+    selic_info = f"Taxa Selic: {session.selic}%" if session.selic else "Taxa Selic não informada. Assuma um valor médio para um perfil moderado (ex: entre 10-12% ao ano)."
+    ipca_info = f"Taxa IPCA: {session.ipca}%" if session.ipca else "Taxa IPCA não informada. Assuma um valor médio da inflação recente."
+    market_perception_info = f"Percepção do mercado de ações (gerada automaticamente): {session.market_perception}" # Ajustado aqui
 
     prompt = f"""
     Você é o MoneyupInvestiments, um instrutor e consultor de investimentos para um perfil **moderado**.
@@ -418,37 +3364,117 @@ async def analyze_investment(ctx):
 
     **Observação Importante:** As sugestões de ativos são **exemplos educativos e simulados**, baseados em uma análise gerada por inteligência artificial com as informações disponíveis. O mercado financeiro é dinâmico e o desempenho passado não garante o futuro. Esta não é uma recomendação de investimento profissional. Consulte sempre um profissional financeiro certificado para decisões reais de investimento.
     """
+    return prompt
+
+# --- Fluxo da Análise (máquina de estados) ---
+# Cada etapa lê e atualiza a sessão e devolve o próximo estado. Uma etapa pode
+# ser reexecutada do início (por exemplo, depois de um reinício do bot).
 
-    await ctx.send("Processando sua análise detalhada de mercado e construindo sua carteira sugerida... Isso pode levar um momento.")
+async def step_investment_value(ctx, session):
+    deliver(ctx, "Olá! Sou o MoneyupInvestiments. Vamos iniciar sua análise de investimento para este mês.")
+    deliver(ctx, "Primeiro, qual o **valor total que você pretende investir este mês** (apenas o número, ex: `1000`)?")
     try:
-        response = model.generate_content(prompt)
-        analysis_text = response.text
-        
-        await send_long_message(ctx, analysis_text) # Chama a função para enviar a mensagem dividida
-        
-        allocation_pattern = r"- \*\*(.*?)\*\*:\s*\[(\d+)\]%"
-        matches = re.findall(allocation_pattern, analysis_text)
-        
-        chart_allocations = {}
-        for asset_type, percentage_str in matches:
-            try:
-                percentage = float(percentage_str)
-                clean_asset_type = re.sub(r'\s*\(.*?\)', '', asset_type).strip()
-                chart_allocations[clean_asset_type] = percentage
-            except ValueError:
-                continue
+        session.investment_value = await conversation_engine.expect(session.key, parse_amount, CONVERSATION_TIMEOUTS[session.state],
+                                                                   ready=message_outbox.flush(ctx))
+    except asyncio.TimeoutError:
+        deliver(ctx, "Tempo esgotado. Por favor, tente `!analisar` novamente.")
+        return AnalysisSession.DONE
+    deliver(ctx, f"Ok, você pretende investir R$ {session.investment_value:,.2f}.")
+    return AnalysisSession.SELIC
+
+def owns_session(session):
+    # Falso depois de um !limpar_dados (ou de um novo !analisar) durante a etapa:
+    # as etapas checam antes de escrever ao usuário depois de cada espera.
+    return analysis_tasks.get(session.key) is asyncio.current_task()
+
+async def step_selic(ctx, session):
+    current_selic, _ = await session.fetch_indicators()
+    if not owns_session(session):
+        return AnalysisSession.DONE
+    if current_selic:
+        session.selic = current_selic
+        deliver(ctx, f"A taxa Selic atual (via API) é: **{session.selic}%**.")
+        return AnalysisSession.IPCA
+    deliver(ctx, "Não consegui buscar a **taxa Selic** atual automaticamente. Poderia me informar qual a taxa Selic desse mês (ex: `10.75`)?")
+    try:
+        session.selic = await conversation_engine.expect(session.key, parse_rate, CONVERSATION_TIMEOUTS[session.state],
+                                                         ready=message_outbox.flush(ctx))
+        deliver(ctx, f"Entendido! Usarei a Selic de **{session.selic}%**.")
+    except asyncio.TimeoutError:
+        deliver(ctx, "Tempo esgotado para informar a Selic. A análise será menos precisa sem essa informação.")
+        session.selic = None
+    return AnalysisSession.IPCA
+
+async def step_ipca(ctx, session):
+    _, current_ipca = await session.fetch_indicators()
+    if not owns_session(session):
+        return AnalysisSession.DONE
+    if current_ipca:
+        session.ipca = current_ipca
+        deliver(ctx, f"A taxa IPCA atual (via API) é: **{session.ipca}%**.")
+        return AnalysisSession.GENERATING
+    deliver(ctx, "Não consegui buscar a **taxa IPCA (inflação)** atual automaticamente. Poderia me informar qual a taxa IPCA desse mês (ex: `0.5`)?")
+    try:
+        session.ipca = await conversation_engine.expect(session.key, parse_rate, CONVERSATION_TIMEOUTS[session.state],
+                                                         ready=message_outbox.flush(ctx))
+        deliver(ctx, f"Ok! Usarei o IPCA de **{session.ipca}%**.")
+    except asyncio.TimeoutError:
+        deliver(ctx, "Tempo esgotado para informar o IPCA. Análise sem essa informação.")
+        session.ipca = None
+    return AnalysisSession.GENERATING
+
+async def step_generate(ctx, session):
+    session.market_perception = get_market_perception(datetime.now().month)
+    deliver(ctx, f"Minha análise do mercado para este mês ({datetime.now().strftime('%B')}): '{session.market_perception}'.")
 
+    investment_value = session.investment_value
+    prompt = build_analysis_prompt(session)
+
+    async def notify_queue_position(position):
+        deliver(ctx, f"Há outras análises em andamento. Você é o **{position}º** na fila; começarei assim que houver uma vaga.")
+
+    try:
+        chart_allocations = {}
+        cache_key = analysis_cache.make_key(investment_value, session.selic, session.ipca, datetime.now().strftime('%Y-%m'))
+        cached_analysis = analysis_cache.get(cache_key, investment_value)
+        if cached_analysis is not None:
+            await send_long_message(ctx, cached_analysis)
+            extract_allocations(cached_analysis, chart_allocations)
+        else:
+            deliver(ctx, "Processando sua análise detalhada de mercado e construindo sua carteira sugerida... Isso pode levar um momento.")
+            if GEMINI_STREAMING:
+                writer = StreamingMessageWriter(ctx, on_text=lambda text: extract_allocations(text, chart_allocations))
+                analysis_text = await generation_engine.generate(session.key, prompt, on_queued=notify_queue_position, on_chunk=writer.feed)
+                await writer.close()
+            else:
+                analysis_text = await generation_engine.generate(session.key, prompt, on_queued=notify_queue_position)
+                await send_long_message(ctx, analysis_text) # Chama a função para enviar a mensagem dividida
+                extract_allocations(analysis_text, chart_allocations)
+            if analysis_text.strip():
+                analysis_cache.put(cache_key, analysis_text, investment_value)
+                merged = await asyncio.to_thread(analysis_cache.save, analysis_cache.snapshot())
+                if merged:
+                    analysis_cache.merge(merged)
+
+        if not owns_session(session):
+            return AnalysisSession.DONE
         if chart_allocations and sum(chart_allocations.values()) > 0:
-            await ctx.send("Aqui está um gráfico de pizza ilustrativo da alocação sugerida:")
+            # A simulação roda enquanto o gráfico de pizza é gerado e enviado
+            projection = asyncio.ensure_future(project_allocation(chart_allocations, investment_value, session.selic, session.ipca))
             chart_file = await generate_pie_chart(chart_allocations, title="Sugestão de Alocação de Carteira")
+            if not owns_session(session):
+                projection.cancel()
+                return AnalysisSession.DONE
             if chart_file:
-                await ctx.send(file=chart_file)
+                deliver(ctx, "Aqui está um gráfico de pizza ilustrativo da alocação sugerida:", file=chart_file)
             else:
-                await ctx.send("Não foi possível gerar o gráfico de alocação.")
+                deliver(ctx, "Não foi possível gerar o gráfico de alocação.")
+            await send_projection(ctx, session, projection)
         else:
-            await ctx.send("Não foi possível extrair dados de alocação para gerar o gráfico.")
+            deliver(ctx, "Não foi possível extrair dados de alocação para gerar o gráfico.")
 
-        await ctx.send(
+        deliver(
+            ctx,
             "\n\nEspero que esta análise detalhada e as sugestões ajudem você a dar seus próximos passos. "
             "Lembre-se de que o mercado muda e é fundamental continuar estudando e, para decisões reais, "
             "sempre considere buscar o conselho de um profissional financeiro certificado. "
@@ -456,12 +3482,80 @@ async def analyze_investment(ctx):
             "Para mais detalhes sobre cada tipo de investimento, use `!conceito [tipo de investimento]`."
         )
 
+    except GenerationCancelled:
+        print(f"Geração cancelada para a sessão {session.key}.")
+    except asyncio.TimeoutError:
+        deliver(ctx, "A análise demorou mais do que o esperado e foi interrompida. Por favor, tente `!analisar` novamente em instantes.")
+        print(f"Timeout ao gerar conteúdo Gemini para a sessão {session.key}.")
     except Exception as e:
-        await ctx.send(f"Desculpe, não consegui gerar a análise no momento. Erro: {e}")
+        deliver(ctx, f"Desculpe, não consegui gerar a análise no momento. Erro: {e}")
         print(f"Erro ao gerar conteúdo Gemini: {e}")
+    return AnalysisSession.DONE
+
+async def send_projection(ctx, session, projection):
+    try:
+        result = await projection
+        chart_file = await generate_projection_chart(result)
+    except asyncio.TimeoutError:
+        print(f"Projeção excedeu o orçamento de {projection_engine.budget}s.")
+        return
+    except Exception as e:
+        print(f"Erro ao projetar a carteira: {e}")
+        return
+    if result is None or not owns_session(session):
+        return
+    deliver(ctx, format_projection_summary(result), file=chart_file)
+
+ANALYSIS_STEPS = {
+    AnalysisSession.AWAITING_VALUE: step_investment_value,
+    AnalysisSession.SELIC: step_selic,
+    AnalysisSession.IPCA: step_ipca,
+    AnalysisSession.GENERATING: step_generate,
+}
+
+async def run_analysis(ctx, session):
+    task = analysis_tasks[session.key] = asyncio.current_task()
+    try:
+        # Para se a sessão for limpa ou substituída por um novo !analisar
+        while session.state != AnalysisSession.DONE and analysis_tasks.get(session.key) is task:
+            session.state = await ANALYSIS_STEPS[session.state](ctx, session)
+            if session.state != AnalysisSession.DONE and analysis_tasks.get(session.key) is task:
+                await user_session_data.put(session)
+    except ConversationCancelled:
+        pass
     finally:
-        if user_id in user_session_data:
-            del user_session_data[user_id]
+        if analysis_tasks.get(session.key) is task:
+            del analysis_tasks[session.key]
+        await user_session_data.delete(session.key, session.session_id)
+        await message_outbox.flush(ctx)
+
+async def resume_sessions():
+    # Retoma as análises interrompidas por um reinício. Só são retomadas as
+    # sessões de canais visíveis para este processo (os demais pertencem a outro shard).
+    try:
+        await user_session_data.sweep(SESSION_TTL)
+        sessions = await user_session_data.all()
+    except Exception as e:
+        print(f"Erro ao carregar sessões salvas: {e}")
+        return
+    for session in sessions:
+        channel = bot.get_channel(session.channel_id)
+        if channel is None or session.key in analysis_tasks:
+            continue
+        print(f"Retomando a sessão {session.key} no estado '{session.state}'.")
+        deliver(channel, f"<@{session.author_id}>, o bot foi reiniciado. Vamos continuar sua análise de onde paramos.")
+        asyncio.ensure_future(run_analysis(channel, session))
+
+@bot.command(name='analisar', help='Inicia uma análise de mercado e sugestões de investimento.')
+async def analyze_investment(ctx):
+    session = AnalysisSession(ctx.channel.id, ctx.author.id)
+    previous = await user_session_data.get(session.key)
+    if previous is not None:
+        conversation_engine.cancel(previous.key)
+    await user_session_data.put(session)
+    # Os indicadores são buscados enquanto o usuário digita o valor
+    session.fetch_indicators()
+    await run_analysis(ctx, session)
 
 # --- Executar o Bot ---
 if __name__ == "__main__":
@@ -471,6 +3565,8 @@ if __name__ == "__main__":
         print("Erro: GEMINI_API_KEY não encontrado. Certifique-se de adicioná-lo nas Secrets do Replit.")
     elif not ALPHA_VANTAGE_API_KEY:
         print("Erro: ALPHA_VANTAGE_API_KEY não encontrado. Certifique-se de adicioná-lo nas Secrets do Replit.")
+    elif BOT_SHARD_MODE == 'multi':
+        run_shard_launcher()
     else:
         bot.run(DISCORD_BOT_TOKEN)
         